@@ -1,8 +1,149 @@
 #!/usr/bin/env python3
 
-from .gradient import get_gradient
+import torch
+import torch.nn as nn
+import torch.nn.utils.prune as prune
 
+from .hutchinson import dataset_hessian_hutchinson
+from .log import get_logger
+from .util import get_model_sparsity, get_pruned_parameters
+from .validator import Validator
 
-def optimal_brain_damage(model, loss):
-    gradient = get_gradient(model, loss)
-    print(gradient.sort())
+
+class OptimalBrainDamage:
+    # normalization layers such as BatchNorm are left alone, zeroing their
+    # scales silences whole channels
+    prunable_layer_types = (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d)
+
+    def __init__(self, model, loss_fun, dataset, prune_bias=False, **kwargs):
+        # kwargs are passed to dataset_hessian_hutchinson; every batch of
+        # probes costs one pass over dataset
+        self.model = model
+        self.loss_fun = loss_fun
+        self.dataset = dataset
+        self.prune_bias = prune_bias
+        self.hutchinson_kwargs = kwargs
+        self.hutchinson_kwargs.setdefault("max_probe_num", 64)
+        self.hutchinson_kwargs.setdefault("target", "diagonal")
+        self.hutchinson_kwargs.setdefault("rtol", 0.1)
+
+    def get_saliencies(self):
+        """
+        Return the saliency 0.5 * h_kk * w_k^2 of every parameter entry,
+        keyed like get_pruned_parameters. h_kk is the Hessian diagonal of the
+        loss over dataset, estimated by Hutchinson probes. Entries that are
+        already pruned get -inf.
+        """
+        validator = Validator(
+            self.model, self.loss_fun, self.dataset, share_model=True)
+        diagonal = dataset_hessian_hutchinson(
+            validator, **self.hutchinson_kwargs).diagonal
+        saliencies = dict()
+        offset = 0
+        # the diagonal follows the order of model.parameters(), which is the
+        # order of get_pruned_parameters
+        for (layer, name), parameter in get_pruned_parameters(self.model).items():
+            h = diagonal[offset: offset + parameter.numel()].view_as(parameter)
+            offset += parameter.numel()
+            weight = getattr(layer, name).detach()
+            saliency = 0.5 * h * weight ** 2
+            if hasattr(layer, name + "_mask"):
+                saliency[getattr(layer, name + "_mask") == 0] = -float("inf")
+            saliencies[(layer, name)] = saliency
+        return saliencies
+
+    def prune(self, sparsity, per_layer=False):
+        """
+        Prune the entries with the lowest saliency until the fraction
+        sparsity of the prunable entries is zero, either over the whole model
+        or within every parameter with per_layer. Only the weights of
+        prunable_layer_types are pruned, and their biases with prune_bias,
+        but every parameter gets a mask so that get_pruning_mask covers the
+        model.
+        """
+        saliencies = self.get_saliencies()
+        prunable = {
+            (layer, name): saliency
+            for (layer, name), saliency in saliencies.items()
+            if isinstance(layer, self.prunable_layer_types)
+            and (self.prune_bias or not name.startswith("bias"))
+        }
+        masks = {key: torch.ones_like(saliency) for key, saliency in saliencies.items()}
+        if per_layer:
+            for key, saliency in prunable.items():
+                OptimalBrainDamage.__mask_lowest(
+                    [saliency], [masks[key]], sparsity)
+        else:
+            OptimalBrainDamage.__mask_lowest(
+                list(prunable.values()), [masks[key] for key in prunable], sparsity
+            )
+        for (layer, name), mask in masks.items():
+            prune.custom_from_mask(layer, name, mask)
+        get_logger().info(
+            "pruned to sparsity %s, non-zero parameters %s%%",
+            sparsity,
+            get_model_sparsity(self.model)[0],
+        )
+
+    @staticmethod
+    def __mask_lowest(saliencies, masks, sparsity):
+        # select exactly the lowest entries, a threshold would also prune the
+        # many ties at zero saliency, e.g. of dead ReLU units
+        flat_saliencies = torch.cat([saliency.view(-1) for saliency in saliencies])
+        prune_num = int(round(sparsity * flat_saliencies.numel()))
+        if prune_num == 0:
+            return
+        flat_mask = torch.ones_like(flat_saliencies)
+        flat_mask[torch.topk(flat_saliencies, prune_num, largest=False).indices] = 0
+        offset = 0
+        for mask in masks:
+            mask.view(-1).copy_(flat_mask[offset: offset + mask.numel()])
+            offset += mask.numel()
+
+
+def prune_and_fine_tune(trainer, sparsities, fine_tune_epoches, per_layer=False,
+                        prune_bias=False, hutchinson_kwargs=None, **kwargs):
+    """
+    Alternate OBD pruning of trainer.model to each sparsity in the
+    increasing list sparsities with fine-tuning by trainer for
+    fine_tune_epoches. hutchinson_kwargs configure the Hessian diagonal
+    estimate and kwargs are passed to trainer.train. Returns the
+    sparsity and the final validation accuracy of every stage.
+    """
+    obd = OptimalBrainDamage(
+        trainer.model,
+        trainer.loss_fun,
+        trainer.training_dataset,
+        prune_bias,
+        **(hutchinson_kwargs or dict())
+    )
+    records = []
+    hyper_parameter = trainer.get_hyper_parameter()
+    epoches = hyper_parameter.epoches
+    try:
+        for sparsity in sparsities:
+            obd.model = trainer.model
+            obd.prune(sparsity, per_layer)
+            hyper_parameter = trainer.get_hyper_parameter()
+            hyper_parameter.epoches = fine_tune_epoches
+            trainer.set_hyper_parameter(hyper_parameter)
+            trainer.train(**kwargs)
+            validation_accuracy = None
+            if trainer.validation_accuracy:
+                validation_accuracy = trainer.validation_accuracy[
+                    max(trainer.validation_accuracy.keys())
+                ]
+            records.append(
+                {"sparsity": sparsity, "validation_accuracy": validation_accuracy}
+            )
+    finally:
+        hyper_parameter = trainer.get_hyper_parameter()
+        hyper_parameter.epoches = epoches
+        trainer.set_hyper_parameter(hyper_parameter)
+    return records
+
+
+def optimal_brain_damage(model, loss_fun, dataset, sparsity, per_layer=False,
+                         **kwargs):
+    OptimalBrainDamage(model, loss_fun, dataset, **kwargs).prune(sparsity, per_layer)
+    return model
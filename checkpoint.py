@@ -0,0 +1,95 @@
+import os
+import random
+import re
+
+import torch
+
+from .log import get_logger
+from .task_queue import TaskQueue
+
+
+def clone_state(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: clone_state(v) for k, v in state.items()}
+    if isinstance(state, list):
+        return [clone_state(v) for v in state]
+    if isinstance(state, tuple):
+        return tuple(clone_state(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    rng_state = {
+        "torch": torch.get_rng_state(),
+        "random": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state["torch"])
+    random.setstate(rng_state["random"])
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
+class Checkpointer:
+    file_pattern = re.compile(r"^checkpoint_(\d+)\.pt$")
+
+    def __init__(self, save_dir, keep_checkpoint_num=3):
+        self.save_dir = save_dir
+        self.keep_checkpoint_num = keep_checkpoint_num
+        self.__queue = None
+
+    def save(self, epoch, state, get_deferred_state=None):
+        # the state is copied synchronously, the disk write happens on a
+        # background thread. get_deferred_state is called on that thread
+        # right before the write and may block, e.g. on a pending validation
+        state = clone_state(state)
+        state["epoch"] = epoch
+        if self.__queue is None:
+            self.__queue = TaskQueue(self.__write, worker_num=1)
+        self.__queue.add_task((epoch, state, get_deferred_state))
+
+    def stop(self):
+        if self.__queue is not None:
+            self.__queue.stop()
+            self.__queue = None
+
+    def get_checkpoints(self):
+        if not os.path.isdir(self.save_dir):
+            return []
+        checkpoints = []
+        for name in os.listdir(self.save_dir):
+            match = Checkpointer.file_pattern.match(name)
+            if match is not None:
+                checkpoints.append(
+                    (int(match.group(1)), os.path.join(self.save_dir, name))
+                )
+        return [path for _, path in sorted(checkpoints)]
+
+    def load_latest(self):
+        checkpoints = self.get_checkpoints()
+        if not checkpoints:
+            return None
+        return torch.load(checkpoints[-1], map_location="cpu")
+
+    def __write(self, task):
+        epoch, state, get_deferred_state = task
+        if get_deferred_state is not None:
+            state.update(clone_state(get_deferred_state()))
+        if not os.path.isdir(self.save_dir):
+            os.makedirs(self.save_dir, exist_ok=True)
+        path = os.path.join(self.save_dir, "checkpoint_{}.pt".format(epoch))
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        get_logger().info("save checkpoint %s", path)
+        checkpoints = self.get_checkpoints()
+        if self.keep_checkpoint_num is not None:
+            for old_path in checkpoints[: -self.keep_checkpoint_num]:
+                os.remove(old_path)
@@ -0,0 +1,40 @@
+import torch
+
+from .log import get_logger
+
+
+class _EagerFallbackModel:
+    # torch.compile is lazy and only fails on the first forward, or on a
+    # recompilation for new input shapes; from then on model runs eagerly.
+    # Other attributes, e.g. no_sync of DistributedDataParallel, come from
+    # model
+    def __init__(self, compiled_model, model):
+        self.compiled_model = compiled_model
+        self.model = model
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled_model is not None:
+            try:
+                return self.compiled_model(*args, **kwargs)
+            except Exception as e:
+                get_logger().warning("can't compile %s, use eager mode: %s",
+                                     self.model.__class__.__name__, e)
+                self.compiled_model = None
+        return self.model(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name in ("compiled_model", "model"):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+def compile_model(model):
+    # the compiled module shares parameters and buffers with model
+    if hasattr(torch, "compile"):
+        return _EagerFallbackModel(torch.compile(model), model)
+    try:
+        return torch.jit.script(model)
+    except Exception as e:
+        get_logger().warning("can't script %s, use eager mode: %s",
+                             model.__class__.__name__, e)
+        return model
@@ -8,9 +8,13 @@ from .dataset import get_dataset
 from .model import LeNet5, densenet_cifar
 
 
-def get_task_configuration(task_name, for_training):
-    training_dataset = get_dataset(task_name, True)
-    validation_dataset = get_dataset(task_name, False)
+def get_task_configuration(
+    task_name, for_training, training_dataset=None, validation_dataset=None
+):
+    if training_dataset is None:
+        training_dataset = get_dataset(task_name, True)
+    if validation_dataset is None:
+        validation_dataset = get_dataset(task_name, False)
     if task_name == "MNIST":
         model = LeNet5()
         loss_fun = nn.CrossEntropyLoss()
@@ -2,41 +2,154 @@
 
 import torch
 from .device import get_device
+from .linear_operator import DenseOperator, FunctionOperator
+from .solver import (
+    ResidualHistory,
+    SolverInfo,
+    apply_operator,
+    get_initial_guess,
+    get_tolerance,
+    safe_divide,
+)
 
 
-def conjugate_gradient(A, b, max_iteration=None, epsilon=0.0001):
+def conjugate_gradient(A, b, max_iteration=None, epsilon=0.0001, **kwargs):
     return conjugate_gradient_general(
-        lambda v: A @ v, b, max_iteration, epsilon)
+        DenseOperator(A), b, max_iteration, epsilon, **kwargs)
 
 
 def conjugate_gradient_general(
     A_product_func,
     b,
     max_iteration=None,
-        epsilon=0.0001):
-    x = torch.ones(b.shape)
-    x = x.to(get_device())
+    epsilon=0.0001,
+    x0=None,
+    preconditioner=None,
+    rtol=0,
+    residual_recompute_interval=50,
+    return_info=False,
+    dtype=None,
+    check_interval=10,
+):
+    """
+    Solve A x = b for a symmetric positive definite A given by A_product_func,
+    a callable or a LinearOperator. preconditioner is a callable applying an
+    approximation of A^-1 to a residual, for example
+    get_jacobi_preconditioner(diagonal). The iteration stops once the
+    residual norm is at most max(rtol * |b|, epsilon). The vectors are
+    updated in place in dtype, e.g. torch.float64 for accumulation, while
+    products are computed in the dtype of b. The residual norm is only
+    synchronized to the host every check_interval iterations. With
+    return_info, a SolverInfo is returned together with x.
+    """
+    operator_dtype = b.dtype
+    if dtype is None:
+        dtype = b.dtype
     if max_iteration is None:
         max_iteration = b.shape[0] * 2
-    r = b - A_product_func(x)
-    d = r
-    new_delta = r @ r
+    tolerance = get_tolerance(b, rtol, epsilon)
+    info = SolverInfo()
+    b = b.to(dtype)
+    x = get_initial_guess(b, x0, dtype)
+    q = torch.empty_like(b)
+    r = apply_operator(A_product_func, x, torch.empty_like(b), operator_dtype)
+    r.neg_().add_(b)
+    residual_history = ResidualHistory(r, check_interval)
+    info.residual_norms = residual_history.residual_norms
+    info.converged = info.residual_norms[0] <= tolerance
+    z = r if preconditioner is None else preconditioner(r)
+    d = z.clone()
+    new_delta = torch.dot(r, z)
     for i in range(max_iteration):
-        q = A_product_func(d)
-        alpha = new_delta / (d @ q)
-        x = x + alpha * d
-        if i % 50 == 0:
-            r = b - A_product_func(x)
+        if info.converged:
+            break
+        apply_operator(A_product_func, d, q, operator_dtype)
+        alpha = safe_divide(new_delta, torch.dot(d, q))
+        x.addcmul_(d, alpha)
+        if residual_recompute_interval and (i + 1) % residual_recompute_interval == 0:
+            apply_operator(A_product_func, x, r, operator_dtype)
+            r.neg_().add_(b)
         else:
-            r = r - alpha * q
+            r.addcmul_(q, alpha, value=-1)
+        info.iteration_num = i + 1
+        residual_history.record(r)
+        if (i + 1) % check_interval == 0 or i + 1 == max_iteration:
+            info.converged = residual_history.flush() <= tolerance
+        z = r if preconditioner is None else preconditioner(r)
         old_delta = new_delta
-        new_delta = r @ r
-        d = r + (new_delta / old_delta) * d
-        if torch.sqrt(new_delta) < epsilon:
-            break
+        new_delta = torch.dot(r, z)
+        d.mul_(safe_divide(new_delta, old_delta)).add_(z)
+    if return_info:
+        return x, info
     return x
 
 
+def block_conjugate_gradient(A, B, max_iteration=None, epsilon=0.0001, **kwargs):
+    return block_conjugate_gradient_general(
+        lambda V: V @ A.T, B, max_iteration, epsilon, **kwargs)
+
+
+def block_conjugate_gradient_general(
+    A_products_func,
+    B,
+    max_iteration=None,
+    epsilon=0.0001,
+    X0=None,
+    preconditioner=None,
+    rtol=0,
+    residual_recompute_interval=50,
+    return_info=False,
+):
+    """
+    Solve A x = b for every row b of the [k, n] matrix B. The rows run
+    conjugate_gradient_general in lockstep, so A_products_func is called
+    with a [m, n] matrix holding the m rows that have not converged yet and
+    must return A applied to each of them. With return_info, a list of k
+    SolverInfo is returned together with X.
+    """
+    X = get_initial_guess(B, X0)
+    if max_iteration is None:
+        max_iteration = B.shape[1] * 2
+    tolerances = torch.clamp(
+        rtol * torch.linalg.norm(B, dim=1), min=epsilon)
+    infos = [SolverInfo() for _ in range(B.shape[0])]
+    R = B - A_products_func(X)
+    residual_norms = torch.linalg.norm(R, dim=1)
+    for info, norm in zip(infos, residual_norms.tolist()):
+        info.residual_norms.append(norm)
+    active = torch.nonzero(residual_norms > tolerances).view(-1)
+    Z = R if preconditioner is None else preconditioner(R)
+    D = Z.clone()
+    deltas = torch.sum(R * Z, dim=1)
+    for i in range(max_iteration):
+        if active.numel() == 0:
+            break
+        # converged rows are deflated and cost no further products
+        active_D = D[active]
+        Q = A_products_func(active_D)
+        alphas = deltas[active] / torch.sum(active_D * Q, dim=1)
+        X[active] += alphas.unsqueeze(1) * active_D
+        if residual_recompute_interval and (i + 1) % residual_recompute_interval == 0:
+            active_R = B[active] - A_products_func(X[active])
+        else:
+            active_R = R[active] - alphas.unsqueeze(1) * Q
+        R[active] = active_R
+        active_norms = torch.linalg.norm(active_R, dim=1)
+        for k, norm in zip(active.tolist(), active_norms.tolist()):
+            infos[k].iteration_num = i + 1
+            infos[k].residual_norms.append(norm)
+        active_Z = active_R if preconditioner is None else preconditioner(active_R)
+        new_deltas = torch.sum(active_R * active_Z, dim=1)
+        D[active] = active_Z + (new_deltas / deltas[active]).unsqueeze(1) * active_D
+        deltas[active] = new_deltas
+        active = active[active_norms > tolerances[active]]
+    for info, tolerance in zip(infos, tolerances.tolist()):
+        info.converged = info.residual_norms[-1] <= tolerance
+    if return_info:
+        return X, infos
+    return X
+
+
 if __name__ == "__main__":
     test_A = torch.Tensor([[1, 2], [2, 1]])
     test_b = torch.Tensor([3, 4])
@@ -45,3 +158,14 @@ if __name__ == "__main__":
     p = conjugate_gradient(test_A, test_b)
     print(test_A @ p)
     print(test_b)
+    # an SPD system through a FunctionOperator, accumulating in float64
+    spd_A = test_A @ test_A.T
+    p, info = conjugate_gradient_general(
+        FunctionOperator(lambda v: spd_A @ v, 2, test_b.dtype),
+        test_b,
+        dtype=torch.float64,
+        check_interval=2,
+        return_info=True,
+    )
+    print(spd_A @ p.float())
+    print(info)
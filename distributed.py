@@ -0,0 +1,143 @@
+import io
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if is_distributed():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return 1
+
+
+def is_master():
+    return get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def all_reduce_gradients(model):
+    for parameter in model.parameters():
+        if parameter.grad is not None:
+            all_reduce_sum(parameter.grad)
+
+
+def broadcast_from_master(obj):
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def distributed_train(
+    trainer,
+    local_world_size,
+    node_rank=0,
+    node_num=1,
+    master_addr="127.0.0.1",
+    master_port=29500,
+    backend="gloo",
+    start_method="fork",
+    **kwargs
+):
+    # returns the trained trainer on node 0 and None on the other nodes.
+    # fork keeps the lambdas in HyperParameter factories and callbacks usable
+    # in the workers; use spawn only with picklable factories.
+    ctx = torch.multiprocessing.get_context(start_method)
+    result_queue = ctx.SimpleQueue()
+    context = torch.multiprocessing.start_processes(
+        _worker,
+        args=(
+            trainer,
+            kwargs,
+            local_world_size,
+            node_rank,
+            node_num,
+            master_addr,
+            master_port,
+            backend,
+            result_queue,
+        ),
+        nprocs=local_world_size,
+        join=False,
+        start_method=start_method,
+    )
+    # join re-raises the error of a failed worker, so poll it instead of
+    # blocking on a result that will never come
+    result = None
+    finished = False
+    while not finished:
+        if node_rank == 0 and result is None and not result_queue.empty():
+            result = result_queue.get()
+        finished = context.join(timeout=1)
+    if node_rank != 0:
+        # the trained model lives on node 0 only
+        return None
+    if result is None:
+        result = result_queue.get()
+    result = torch.load(io.BytesIO(result))
+    trainer.model.load_state_dict(result["model"])
+    trainer.training_loss = result["training_loss"]
+    trainer.validation_loss = result["validation_loss"]
+    trainer.validation_accuracy = result["validation_accuracy"]
+    return trainer
+
+
+def _worker(
+    local_rank,
+    trainer,
+    kwargs,
+    local_world_size,
+    node_rank,
+    node_num,
+    master_addr,
+    master_port,
+    backend,
+    result_queue,
+):
+    rank = node_rank * local_world_size + local_rank
+    dist.init_process_group(
+        backend,
+        init_method="tcp://{}:{}".format(master_addr, master_port),
+        rank=rank,
+        world_size=local_world_size * node_num,
+    )
+    torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+    try:
+        trainer.train(**kwargs)
+        if rank == 0:
+            # send bytes rather than tensors: shared memory handles of tensors
+            # become invalid once this process exits
+            buffer = io.BytesIO()
+            torch.save(
+                {
+                    "model": {
+                        k: v.detach().cpu()
+                        for k, v in trainer.model.state_dict().items()
+                    },
+                    "training_loss": trainer.training_loss,
+                    "validation_loss": trainer.validation_loss,
+                    "validation_accuracy": trainer.validation_accuracy,
+                },
+                buffer,
+            )
+            result_queue.put(buffer.getvalue())
+    finally:
+        dist.destroy_process_group()
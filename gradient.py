@@ -1,8 +1,118 @@
 #!/usr/bin/env python3
+import torch
 import torch.autograd as autograd
+import torch.nn as nn
+
+try:
+    from torch.func import functional_call, grad_and_value, vmap
+except ImportError:
+    functional_call = None
 
 from .util import parameters_to_vector
 
 
 def get_gradient(model, loss):
     return parameters_to_vector(autograd.grad(loss, model.parameters()))
+
+
+def get_per_instance_gradients(
+        model, loss_fun, inputs, targets, chunk_size=None, loss_scale=1):
+    """
+    Yield (begin, end, instance_losses, instance_gradients) blocks where
+    instance_gradients is a [end - begin, num_params] tensor holding the
+    gradient of each instance's loss. The backward pass runs on the losses
+    times loss_scale, e.g. the scale of a GradScaler for float16, and the
+    gradients are yielded scaled while the losses are not.
+    """
+    batch_size = inputs.shape[0]
+    if chunk_size is None:
+        chunk_size = batch_size
+    gradient_fun = None
+    if _can_vectorize(model):
+        gradient_fun = _get_vectorized_gradient_fun(model, loss_fun, loss_scale)
+    for begin in range(0, batch_size, chunk_size):
+        end = min(begin + chunk_size, batch_size)
+        if gradient_fun is not None:
+            instance_losses, instance_gradients = gradient_fun(
+                inputs[begin:end], targets[begin:end]
+            )
+        else:
+            instance_losses, instance_gradients = _get_looped_gradients(
+                model, loss_fun, inputs[begin:end], targets[begin:end], loss_scale
+            )
+        yield begin, end, instance_losses, instance_gradients
+
+
+def _can_vectorize(model):
+    return functional_call is not None
+
+
+def _get_training_batch_norms(model):
+    return [
+        module
+        for module in model.modules()
+        if isinstance(module, nn.modules.batchnorm._BatchNorm)
+        and module.training
+        and module.track_running_stats
+    ]
+
+
+def _get_vectorized_gradient_fun(model, loss_fun, loss_scale=1):
+    names = [name for name, _ in model.named_parameters()]
+    parameters = {
+        name: parameter.detach() for name, parameter in model.named_parameters()
+    }
+    buffers = {name: buffer.detach() for name, buffer in model.named_buffers()}
+
+    def compute_loss(parameters, buffers, instance_input, instance_target):
+        output = functional_call(
+            model, (parameters, buffers), (instance_input.unsqueeze(0),)
+        )
+        return loss_fun(output, instance_target.unsqueeze(0)) * loss_scale
+
+    # every instance draws its own dropout mask, as in separate passes
+    vectorized_fun = vmap(
+        grad_and_value(compute_loss),
+        in_dims=(None, None, 0, 0),
+        randomness="different",
+    )
+    batch_norms = _get_training_batch_norms(model)
+
+    def gradient_fun(instance_inputs, instance_targets):
+        # vmap can't update the running statistics of batch norm layers in
+        # place. Each instance is normalized by its own statistics as in a
+        # separate pass, then the running statistics are updated by one
+        # forward pass over the expanded batch.
+        for module in batch_norms:
+            module.track_running_stats = False
+        try:
+            gradients, instance_losses = vectorized_fun(
+                parameters, buffers, instance_inputs, instance_targets
+            )
+        finally:
+            for module in batch_norms:
+                module.track_running_stats = True
+        if batch_norms:
+            with torch.no_grad():
+                model(instance_inputs)
+        instance_gradients = torch.cat(
+            [gradients[name].reshape(instance_inputs.shape[0], -1)
+             for name in names],
+            dim=1,
+        )
+        return instance_losses.detach() / loss_scale, instance_gradients
+
+    return gradient_fun
+
+
+def _get_looped_gradients(
+        model, loss_fun, instance_inputs, instance_targets, loss_scale=1):
+    instance_losses = []
+    instance_gradients = []
+    for instance_input, instance_target in zip(
+            instance_inputs, instance_targets):
+        output = model(torch.stack([instance_input]))
+        loss = loss_fun(output, torch.stack([instance_target]))
+        instance_losses.append(loss.detach().reshape(()))
+        instance_gradients.append(get_gradient(model, loss * loss_scale))
+    return torch.stack(instance_losses), torch.stack(instance_gradients)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import torch
 import torch.autograd as autograd
 from .device import get_device
 from .util import parameters_to_vector
@@ -19,3 +20,47 @@ def hessian_vector_product(model, loss, v, damping=0):
     if damping != 0:
         res += damping * v
     return res
+
+
+def hessian_vector_products(model, loss, vectors, damping=0, chunk_size=None):
+    """
+    Compute H @ v for every row v of the [k, num_params] matrix vectors,
+    reusing the first-order graph of loss for all rows.
+    """
+    model.zero_grad()
+    parameters = list(model.parameters())
+    grad = parameters_to_vector(
+        autograd.grad(loss, parameters, create_graph=True))
+    if chunk_size is None:
+        chunk_size = vectors.shape[0]
+    products = []
+    for chunk in torch.split(vectors.to(grad.device), chunk_size):
+        try:
+            res = autograd.grad(
+                grad,
+                parameters,
+                grad_outputs=chunk,
+                retain_graph=True,
+                is_grads_batched=True,
+            )
+            products.append(
+                torch.cat([r.reshape(chunk.shape[0], -1) for r in res], dim=1)
+            )
+        except (TypeError, RuntimeError):
+            # is_grads_batched needs torch 1.11, and vmap fails on ops
+            # without a batching rule for their double backward
+            products.append(
+                torch.stack(
+                    [
+                        parameters_to_vector(
+                            autograd.grad(
+                                grad @ v, parameters, retain_graph=True)
+                        )
+                        for v in chunk
+                    ]
+                )
+            )
+    res = torch.cat(products)
+    if damping != 0:
+        res += damping * vectors.to(res.device)
+    return res
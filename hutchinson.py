@@ -0,0 +1,172 @@
+import math
+
+import torch
+
+from .device import get_device
+from .hessian_vector_product import hessian_vector_products
+from .util import model_parameters_to_vector
+
+
+class HutchinsonResult:
+    def __init__(self, probe_num, diagonal, diagonal_std_error):
+        self.probe_num = probe_num
+        self.diagonal = diagonal
+        self.diagonal_std_error = diagonal_std_error
+        self.trace = None
+        self.trace_std_error = None
+        # per layer traces of the block diagonal, keyed by layer name
+        self.block_traces = dict()
+        self.block_trace_std_errors = dict()
+        self.converged = False
+
+
+class _Welford:
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, samples):
+        # merge the statistics of a batch of samples along dim 0
+        count = samples.shape[0]
+        mean = samples.mean(dim=0)
+        m2 = ((samples - mean) ** 2).sum(dim=0)
+        if self.mean is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def get_std_error(self):
+        if self.count < 2:
+            return torch.full_like(self.mean, math.inf)
+        return torch.sqrt(self.m2 / (self.count - 1) / self.count)
+
+
+def hutchinson(
+    A_products_func,
+    v_like,
+    block_sizes=None,
+    block_names=None,
+    probe_batch_size=16,
+    max_probe_num=256,
+    min_probe_num=None,
+    rtol=0.01,
+    target="trace",
+    seed=0,
+):
+    """
+    Estimate the trace, the diagonal and the traces of the diagonal blocks
+    given by block_sizes of the symmetric operator A_products_func, which
+    maps a [m, n] matrix of probes to A applied to every row. Rademacher
+    probes are drawn probe_batch_size at a time from a generator seeded
+    with seed, and drawing stops once the standard error of target
+    ("trace", "diagonal" or "blocks") is at most rtol times its estimate.
+    """
+    if min_probe_num is None:
+        min_probe_num = min(2 * probe_batch_size, max_probe_num)
+    if block_sizes is None:
+        block_sizes = [v_like.shape[0]]
+    if block_names is None:
+        block_names = list(range(len(block_sizes)))
+    generator = torch.Generator().manual_seed(seed)
+    diagonal_stat = _Welford()
+    trace_stat = _Welford()
+    block_stat = _Welford()
+    converged = False
+    while diagonal_stat.count < max_probe_num:
+        probe_num = min(probe_batch_size, max_probe_num - diagonal_stat.count)
+        probes = (
+            torch.randint(0, 2, (probe_num, v_like.shape[0]), generator=generator) * 2
+            - 1
+        ).to(dtype=v_like.dtype, device=v_like.device)
+        diagonal_samples = probes * A_products_func(probes)
+        diagonal_stat.update(diagonal_samples)
+        trace_stat.update(diagonal_samples.sum(dim=1))
+        block_stat.update(
+            torch.stack(
+                [block.sum(dim=1)
+                 for block in torch.split(diagonal_samples, block_sizes, dim=1)],
+                dim=1,
+            )
+        )
+        if diagonal_stat.count < min_probe_num:
+            continue
+        if target == "trace":
+            converged = (
+                trace_stat.get_std_error() <= rtol * trace_stat.mean.abs()).item()
+        elif target == "diagonal":
+            converged = (
+                torch.linalg.norm(diagonal_stat.get_std_error())
+                <= rtol * torch.linalg.norm(diagonal_stat.mean)
+            ).item()
+        elif target == "blocks":
+            converged = torch.all(
+                block_stat.get_std_error() <= rtol * block_stat.mean.abs()
+            ).item()
+        else:
+            raise ValueError("unknown target:" + str(target))
+        if converged:
+            break
+
+    result = HutchinsonResult(
+        diagonal_stat.count, diagonal_stat.mean, diagonal_stat.get_std_error()
+    )
+    result.trace = trace_stat.mean.item()
+    result.trace_std_error = trace_stat.get_std_error().item()
+    for name, trace, std_error in zip(
+        block_names, block_stat.mean.tolist(), block_stat.get_std_error().tolist()
+    ):
+        result.block_traces[name] = trace
+        result.block_trace_std_errors[name] = std_error
+    result.converged = converged
+    return result
+
+
+def get_layer_blocks(model):
+    # parameters are grouped by the module owning them, in the order of
+    # model_parameters_to_vector
+    block_names = []
+    block_sizes = []
+    for name, parameter in model.named_parameters():
+        layer_name = name.rsplit(".", 1)[0] if "." in name else ""
+        if block_names and block_names[-1] == layer_name:
+            block_sizes[-1] += parameter.numel()
+        else:
+            block_names.append(layer_name)
+            block_sizes.append(parameter.numel())
+    return block_names, block_sizes
+
+
+def hessian_hutchinson(model, loss, **kwargs):
+    """
+    Run hutchinson on the Hessian of loss with per layer blocks.
+    """
+    block_names, block_sizes = get_layer_blocks(model)
+    parameters = model_parameters_to_vector(model)
+    return hutchinson(
+        lambda V: hessian_vector_products(model, loss, V),
+        parameters.detach(),
+        block_sizes=block_sizes,
+        block_names=block_names,
+        **kwargs
+    )
+
+
+def dataset_hessian_hutchinson(validator, chunk_size=None, **kwargs):
+    """
+    Run hutchinson on the Hessian of the whole dataset of validator; every
+    batch of probes costs one pass over the dataset.
+    """
+    block_names, block_sizes = get_layer_blocks(validator.model)
+    parameters = model_parameters_to_vector(validator.model)
+    return hutchinson(
+        lambda V: validator.hessian_vector_products(V, chunk_size=chunk_size),
+        parameters.detach().to(get_device()),
+        block_sizes=block_sizes,
+        block_names=block_names,
+        **kwargs
+    )
@@ -2,15 +2,28 @@ import torch
 
 
 class HyperParameter:
-    def __init__(self, epoches, batch_size, learning_rate, weight_decay=0):
+    def __init__(
+        self,
+        epoches,
+        batch_size,
+        learning_rate,
+        weight_decay=0,
+        micro_batch_size=None,
+    ):
         self.epoches = epoches
         self.batch_size = batch_size
+        self.micro_batch_size = micro_batch_size
         self.learning_rate = learning_rate
         self.weight_decay = weight_decay
         self.lr_scheduler_factory = lambda optimizer: torch.optim.lr_scheduler.LambdaLR(
             optimizer, lr_lambda=(lambda _: 1))
         self.optimizer_factory = None
 
+    def get_micro_batch_size(self):
+        if self.micro_batch_size is None:
+            return self.batch_size
+        return min(self.micro_batch_size, self.batch_size)
+
     def set_lr_scheduler_factory(self, lr_scheduler_factory):
         self.lr_scheduler_factory = lr_scheduler_factory
 
@@ -23,3 +36,27 @@ class HyperParameter:
     def get_optimizer(self, params):
         return self.optimizer_factory(
             params, self.learning_rate, self.weight_decay)
+
+
+class OptimizerFactory:
+    # a picklable optimizer factory, e.g. for the trials of a
+    # HyperParameterSweep run in spawned processes
+    def __init__(self, optimizer_class, **kwargs):
+        self.optimizer_class = optimizer_class
+        self.kwargs = kwargs
+
+    def __call__(self, params, learning_rate, weight_decay):
+        return self.optimizer_class(
+            params, lr=learning_rate, weight_decay=weight_decay, **self.kwargs
+        )
+
+
+class LRSchedulerFactory:
+    # the picklable counterpart of OptimizerFactory for learning rate
+    # schedulers
+    def __init__(self, lr_scheduler_class, **kwargs):
+        self.lr_scheduler_class = lr_scheduler_class
+        self.kwargs = kwargs
+
+    def __call__(self, optimizer):
+        return self.lr_scheduler_class(optimizer, **self.kwargs)
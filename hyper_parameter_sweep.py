@@ -0,0 +1,239 @@
+import itertools
+import os
+import queue
+import random
+import shutil
+import tempfile
+import traceback
+
+import torch.multiprocessing
+
+from .checkpoint import Checkpointer
+from .configuration import get_task_configuration
+from .dataset import get_dataset
+from .log import get_logger
+from .task_queue import ProcessTaskQueue
+
+
+def get_grid_search_space(search_space):
+    names = sorted(search_space.keys())
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*[search_space[name] for name in names])
+    ]
+
+
+def get_random_search_space(search_space, trial_num, seed=0):
+    # a value is either a list to choose from or a callable taking a
+    # random.Random instance
+    rng = random.Random(seed)
+    names = sorted(search_space.keys())
+    trials = []
+    for _ in range(trial_num):
+        parameters = dict()
+        for name in names:
+            value = search_space[name]
+            if callable(value):
+                parameters[name] = value(rng)
+            else:
+                parameters[name] = rng.choice(value)
+        trials.append(parameters)
+    return trials
+
+
+# datasets are loaded once per worker process and shared by its trials
+_worker_datasets = dict()
+
+
+def _get_datasets(task_name):
+    if task_name not in _worker_datasets:
+        _worker_datasets[task_name] = (
+            get_dataset(task_name, True),
+            get_dataset(task_name, False),
+        )
+    return _worker_datasets[task_name]
+
+
+def _run_trial(task, result_queue):
+    (
+        trial_id,
+        task_name,
+        parameters,
+        epoches,
+        metric,
+        thread_num,
+        checkpoint_dir,
+    ) = task
+    try:
+        # concurrent workers would otherwise oversubscribe the cores
+        torch.set_num_threads(thread_num)
+        training_dataset, validation_dataset = _get_datasets(task_name)
+        trainer = get_task_configuration(
+            task_name,
+            True,
+            training_dataset=training_dataset,
+            validation_dataset=validation_dataset,
+        )
+        hyper_parameter = trainer.get_hyper_parameter()
+        hyper_parameter.epoches = epoches
+        for name, value in parameters.items():
+            if name == "optimizer_factory":
+                hyper_parameter.set_optimizer_factory(value)
+            elif name == "lr_scheduler_factory":
+                hyper_parameter.set_lr_scheduler_factory(value)
+            else:
+                setattr(hyper_parameter, name, value)
+        trainer.set_hyper_parameter(hyper_parameter)
+        # a promoted trial continues from the end of its previous rung, only
+        # the checkpoint of the last epoch is written
+        train_kwargs = {
+            "checkpoint_epoch_interval": epoches,
+            "keep_checkpoint_num": 1,
+        }
+        if Checkpointer(checkpoint_dir).get_checkpoints():
+            trainer.resume(checkpoint_dir, **train_kwargs)
+        else:
+            trainer.train(checkpoint_dir=checkpoint_dir, **train_kwargs)
+        values = getattr(trainer, metric)
+        if isinstance(values, dict):
+            values = [values[epoch] for epoch in sorted(values.keys())]
+        result_queue.put((trial_id, values[-1]))
+    except Exception as e:
+        get_logger().error("trial %s failed:%s", trial_id, e)
+        get_logger().error("traceback:%s", traceback.format_exc())
+        result_queue.put((trial_id, None))
+
+
+class HyperParameterSweep:
+    def __init__(
+        self,
+        task_name,
+        trials,
+        worker_num=1,
+        metric="validation_accuracy",
+        maximize=True,
+        checkpoint_dir=None,
+    ):
+        # trials are dicts of HyperParameter fields; with spawned workers the
+        # values must be picklable, so use OptimizerFactory and
+        # LRSchedulerFactory instead of lambdas. Every worker uses
+        # cpu_count / worker_num threads. Trials are checkpointed under
+        # checkpoint_dir, a temporary directory removed after run by default
+        self.task_name = task_name
+        self.checkpoint_dir = checkpoint_dir
+        self.poll_interval = 10
+        self.trials = trials
+        self.worker_num = worker_num
+        self.metric = metric
+        self.maximize = maximize
+        self.results = []
+
+    def run(self, max_epoches, min_epoches=None, reduction_factor=3):
+        """
+        Run successive halving: every rung trains the surviving trials for
+        reduction_factor times the previous epoch budget and keeps the best
+        1/reduction_factor of them. Survivors resume from the checkpoint of
+        their previous rung instead of training from scratch. Without
+        min_epoches every trial is trained for max_epoches.
+        """
+        if min_epoches is None:
+            min_epoches = max_epoches
+        checkpoint_dir = self.checkpoint_dir
+        if checkpoint_dir is None:
+            checkpoint_dir = tempfile.mkdtemp(prefix="hyper_parameter_sweep_")
+        result_queue = torch.multiprocessing.get_context("spawn").Queue()
+        task_queue = ProcessTaskQueue(
+            _run_trial,
+            worker_num=self.worker_num,
+            task_extra_args=result_queue,
+        )
+        self.results = []
+        survivors = list(range(len(self.trials)))
+        epoches = min_epoches
+        stopped = False
+        try:
+            while True:
+                epoches = min(epoches, max_epoches)
+                for trial_id in survivors:
+                    task_queue.add_task(
+                        (
+                            trial_id,
+                            self.task_name,
+                            self.trials[trial_id],
+                            epoches,
+                            self.metric,
+                            max(1, (os.cpu_count() or 1) // self.worker_num),
+                            os.path.join(
+                                checkpoint_dir, "trial_{}".format(trial_id)),
+                        )
+                    )
+                rung_results = dict()
+                for _ in survivors:
+                    trial_id, value = self.__get_result(result_queue, task_queue)
+                    rung_results[trial_id] = value
+                    self.results.append(
+                        {
+                            "trial_id": trial_id,
+                            "parameters": self.trials[trial_id],
+                            "epoches": epoches,
+                            self.metric: value,
+                        }
+                    )
+                    get_logger().info(
+                        "trial %s with %s epoches: %s = %s",
+                        trial_id,
+                        epoches,
+                        self.metric,
+                        value,
+                    )
+                survivors = self.__sort_trials(rung_results)
+                if epoches >= max_epoches or len(survivors) <= 1:
+                    break
+                survivors = survivors[: max(1, len(survivors) // reduction_factor)]
+                epoches *= reduction_factor
+            task_queue.stop()
+            stopped = True
+        finally:
+            if not stopped:
+                task_queue.force_stop()
+            if self.checkpoint_dir is None:
+                shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return self.get_best_trial()
+
+    def __get_result(self, result_queue, task_queue):
+        # a worker killed e.g. by the OOM killer never reports its trial
+        while True:
+            try:
+                return result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                for processor in task_queue.processors:
+                    if not processor.is_alive():
+                        raise RuntimeError(
+                            "sweep worker exited with code {}".format(
+                                processor.exitcode
+                            )
+                        )
+
+    def get_best_trial(self):
+        if not self.results:
+            return None
+        max_epoches = max(result["epoches"] for result in self.results)
+        final_results = {
+            result["trial_id"]: result[self.metric]
+            for result in self.results
+            if result["epoches"] == max_epoches
+        }
+        survivors = self.__sort_trials(final_results)
+        if not survivors:
+            return None
+        return self.trials[survivors[0]]
+
+    def __sort_trials(self, rung_results):
+        finished = [
+            trial_id for trial_id, value in rung_results.items() if value is not None
+        ]
+        return sorted(
+            finished,
+            key=lambda trial_id: rung_results[trial_id],
+            reverse=self.maximize,
+        )
@@ -0,0 +1,242 @@
+import os
+
+import torch
+
+from .conjugate_gradient import block_conjugate_gradient_general
+from .dataset import DatasetWithIndices
+from .device import get_device
+from .gradient import get_per_instance_gradients
+from .util import (
+    get_model_fingerprint,
+    get_model_version,
+    model_gradients_to_vector,
+)
+from .validator import Validator
+
+
+class InfluenceEngine:
+    def __init__(
+        self, model, loss_fun, training_dataset, damping=0.01, batch_size=64,
+    ):
+        # the model is shared, cached results are dropped once its
+        # parameters change
+        self.model = model
+        self.loss_fun = loss_fun
+        self.training_dataset = training_dataset
+        self.damping = damping
+        self.batch_size = batch_size
+        self.chunk_size = None
+        # solver(A_product_func, b) replaces conjugate gradient; persisted
+        # results are keyed by its qualified name, so use a named function
+        self.solver = None
+        self.cache_dir = None
+        self.__training_validator = Validator(
+            model, loss_fun, training_dataset, share_model=True
+        )
+        self.__version = None
+        self.__s_tests = dict()
+        self.__scores = dict()
+        # unnamed test datasets are keyed by id, holding them keeps their
+        # ids from being reused
+        self.__datasets = dict()
+
+    def get_s_test(self, test_dataset, name=None):
+        """
+        Return s_test = (H + damping * I)^-1 grad L_test, where H is the
+        Hessian of the training loss. name identifies test_dataset in the
+        caches and is required for persisting to cache_dir.
+        """
+        return self.get_s_tests([test_dataset], [name])[0]
+
+    def get_s_tests(self, test_datasets, names=None):
+        """
+        Return a [k, num_params] matrix of s_test, one row per test dataset.
+        Missing rows are solved together by block conjugate gradient.
+        """
+        self.__check_version()
+        if names is None:
+            names = [None] * len(test_datasets)
+        keys = [
+            self.__get_key(dataset, name)
+            for dataset, name in zip(test_datasets, names)
+        ]
+        missing = []
+        for dataset, name, key in zip(test_datasets, names, keys):
+            if key in self.__s_tests:
+                continue
+            s_test = self.__load(name, "s_test")
+            if s_test is not None:
+                self.__s_tests[key] = s_test
+            else:
+                missing.append((dataset, name, key))
+        if missing:
+            test_gradients = torch.stack(
+                [self.__get_test_gradient(dataset) for dataset, _, _ in missing]
+            )
+            for (_, name, key), s_test in zip(
+                missing, self.__solve(test_gradients)
+            ):
+                self.__s_tests[key] = s_test
+                self.__save(name, "s_test", s_test)
+        return torch.stack([self.__s_tests[key] for key in keys])
+
+    def get_scores(self, test_dataset, name=None):
+        """
+        Return the influence -grad L_test^T (H + damping * I)^-1 grad L_z of
+        upweighting every training instance z on the test loss, indexed by
+        training instance. Negative scores are helpful, positive ones
+        harmful.
+        """
+        return self.get_all_scores([test_dataset], [name])[:, 0]
+
+    def get_all_scores(self, test_datasets, names=None):
+        """
+        Return a [len(training_dataset), k] score matrix for k test datasets,
+        computed in a single pass over the training set.
+        """
+        if names is None:
+            names = [None] * len(test_datasets)
+        s_tests = self.get_s_tests(test_datasets, names)
+        keys = [
+            self.__get_key(dataset, name)
+            for dataset, name in zip(test_datasets, names)
+        ]
+        missing = []
+        for i, (name, key) in enumerate(zip(names, keys)):
+            if key in self.__scores:
+                continue
+            scores = self.__load(name, "scores")
+            if scores is not None:
+                self.__scores[key] = scores
+            else:
+                missing.append(i)
+        if missing:
+            all_scores = self.__compute_scores(s_tests[missing])
+            for j, i in enumerate(missing):
+                self.__scores[keys[i]] = all_scores[:, j]
+                self.__save(names[i], "scores", all_scores[:, j])
+        return torch.stack([self.__scores[key] for key in keys], dim=1)
+
+    def get_top_helpful(self, test_dataset, k, name=None):
+        scores = self.get_scores(test_dataset, name)
+        values, indices = torch.topk(scores, min(k, scores.shape[0]), largest=False)
+        return indices.tolist(), values.tolist()
+
+    def get_top_harmful(self, test_dataset, k, name=None):
+        scores = self.get_scores(test_dataset, name)
+        values, indices = torch.topk(scores, min(k, scores.shape[0]))
+        return indices.tolist(), values.tolist()
+
+    def __get_test_gradient(self, test_dataset):
+        # the gradient of the mean test loss, matching the scale of the
+        # training Hessian; Validator.get_gradient sums batch means instead
+        Validator(
+            self.model, self.loss_fun, test_dataset, share_model=True
+        ).validate(64, use_grad=True, mean_gradient=True)
+        return model_gradients_to_vector(self.model)
+
+    def __solve(self, test_gradients):
+        if self.solver is not None:
+            return torch.stack(
+                [
+                    self.solver(
+                        lambda v: self.__training_validator.hessian_vector_product(
+                            v, self.damping
+                        ),
+                        b,
+                    )
+                    for b in test_gradients
+                ]
+            )
+        return block_conjugate_gradient_general(
+            lambda V: self.__training_validator.hessian_vector_products(
+                V, self.damping, self.chunk_size
+            ),
+            test_gradients,
+            epsilon=0,
+            X0=torch.zeros_like(test_gradients),
+            rtol=1e-3,
+        )
+
+    def __compute_scores(self, s_tests):
+        device = get_device()
+        training = self.model.training
+        self.model.eval()
+        self.model.to(device)
+        s_tests = s_tests.to(device)
+        scores = torch.zeros(
+            (len(self.training_dataset), s_tests.shape[0]),
+            dtype=s_tests.dtype,
+            device=device,
+        )
+        data_loader = torch.utils.data.DataLoader(
+            DatasetWithIndices(self.training_dataset),
+            batch_size=self.batch_size,
+        )
+        try:
+            for inputs, targets, indices in data_loader:
+                inputs = inputs.to(device, non_blocking=True)
+                targets = targets.to(device, non_blocking=True)
+                indices = indices.to(device)
+                for begin, end, _, instance_gradients in get_per_instance_gradients(
+                    self.model, self.loss_fun, inputs, targets, self.chunk_size
+                ):
+                    scores[indices[begin:end]] = -instance_gradients @ s_tests.T
+        finally:
+            self.model.train(training)
+        return scores.cpu()
+
+    def __check_version(self):
+        # s_test depends on the weights, the damping and the solver
+        self.model.to(get_device())
+        version = (get_model_version(self.model), self.damping, self.solver)
+        if version != self.__version:
+            self.__version = version
+            self.__s_tests = dict()
+            self.__scores = dict()
+            self.__datasets = dict()
+
+    def __get_key(self, dataset, name):
+        if name is not None:
+            return name
+        self.__datasets[id(dataset)] = dataset
+        return id(dataset)
+
+    def __get_solver_name(self):
+        if self.solver is None:
+            return "conjugate_gradient"
+        return "{}.{}".format(
+            getattr(self.solver, "__module__", ""),
+            getattr(self.solver, "__qualname__", self.solver.__class__.__name__),
+        )
+
+    def __get_cache_path(self, name, kind):
+        if self.cache_dir is None or name is None:
+            return None
+        return os.path.join(
+            self.cache_dir,
+            "{}_{}_damping_{}_{}.{}.pt".format(
+                name,
+                get_model_fingerprint(self.model),
+                self.damping,
+                self.__get_solver_name(),
+                kind,
+            ),
+        )
+
+    def __load(self, name, kind):
+        path = self.__get_cache_path(name, kind)
+        if path is None or not os.path.isfile(path):
+            return None
+        return torch.load(path, map_location="cpu").to(
+            get_device() if kind == "s_test" else "cpu"
+        )
+
+    def __save(self, name, kind, tensor):
+        path = self.__get_cache_path(name, kind)
+        if path is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        torch.save(tensor.detach().cpu(), tmp_path)
+        os.replace(tmp_path, path)
@@ -0,0 +1,159 @@
+import math
+
+import torch
+
+from .device import get_device
+from .util import model_parameters_to_vector
+
+
+def lanczos(A_product_func, v0, iteration_num, reorthogonalization="full"):
+    """
+    Run iteration_num Lanczos steps for the symmetric operator A_product_func
+    starting from v0. reorthogonalization is "full", "selective" (only
+    against converged Ritz vectors) or None. Returns the diagonal and the
+    off-diagonal of the tridiagonal matrix and the [m, n] Lanczos basis.
+    """
+    q = v0 / torch.linalg.norm(v0)
+    basis = [q]
+    alphas = []
+    betas = []
+    q_prev = None
+    for j in range(iteration_num):
+        w = A_product_func(q)
+        alpha = (w @ q).item()
+        alphas.append(alpha)
+        w = w - alpha * q
+        if q_prev is not None:
+            w = w - betas[-1] * q_prev
+        if reorthogonalization == "full":
+            Q = torch.stack(basis)
+            # two passes are enough to restore orthogonality in floating point
+            w = w - Q.T @ (Q @ w)
+            w = w - Q.T @ (Q @ w)
+        beta = torch.linalg.norm(w).item()
+        if reorthogonalization == "selective":
+            w = _reorthogonalize_selectively(w, alphas, betas, beta, basis)
+            beta = torch.linalg.norm(w).item()
+        # a vanishing beta means the basis spans an invariant subspace
+        if j + 1 == iteration_num or beta <= 1e-10 * max(abs(a) for a in alphas):
+            break
+        betas.append(beta)
+        q_prev = q
+        q = w / beta
+        basis.append(q)
+    return alphas, betas, torch.stack(basis[: len(alphas)])
+
+
+def _reorthogonalize_selectively(w, alphas, betas, beta, basis):
+    # Ritz pairs whose residual bound beta * |s_mi| is small have converged,
+    # and new Lanczos vectors lose orthogonality against exactly those
+    ritz_values, S = _eigh_tridiagonal(alphas, betas)
+    threshold = math.sqrt(torch.finfo(w.dtype).eps) * ritz_values.abs().max()
+    converged = torch.nonzero(beta * S[-1].abs() <= threshold).view(-1)
+    if converged.numel() == 0:
+        return w
+    Q = torch.stack(basis[: len(alphas)])
+    Y = S[:, converged].T.to(dtype=Q.dtype, device=Q.device) @ Q
+    return w - Y.T @ (Y @ w)
+
+
+def _eigh_tridiagonal(alphas, betas):
+    T = torch.diag(torch.tensor(alphas, dtype=torch.float64))
+    if betas:
+        off_diagonal = torch.tensor(betas[: len(alphas) - 1], dtype=torch.float64)
+        T += torch.diag(off_diagonal, 1) + torch.diag(off_diagonal, -1)
+    return torch.linalg.eigh(T)
+
+
+def lanczos_eigenpairs(
+    A_product_func,
+    v0,
+    k=1,
+    which="largest",
+    iteration_num=None,
+    reorthogonalization="full",
+):
+    """
+    Return the k largest or smallest eigenvalues and the [k, n] eigenvectors
+    of A_product_func, ordered from the most extreme eigenvalue inwards.
+    """
+    if iteration_num is None:
+        iteration_num = max(4 * k, 30)
+    iteration_num = min(iteration_num, v0.shape[0])
+    alphas, betas, basis = lanczos(
+        A_product_func, v0, iteration_num, reorthogonalization)
+    ritz_values, S = _eigh_tridiagonal(alphas, betas)
+    k = min(k, len(alphas))
+    if which == "largest":
+        indices = torch.arange(len(alphas) - 1, len(alphas) - 1 - k, -1)
+    elif which == "smallest":
+        indices = torch.arange(k)
+    else:
+        raise ValueError("unknown which:" + str(which))
+    eigenvectors = S[:, indices].T.to(dtype=basis.dtype, device=basis.device) @ basis
+    return ritz_values[indices].to(basis.dtype), eigenvectors
+
+
+def get_spectral_density(
+    A_product_func,
+    v_like,
+    iteration_num=30,
+    probe_num=10,
+    reorthogonalization=None,
+    seed=0,
+):
+    """
+    Stochastic Lanczos quadrature: every Rademacher probe gives the Ritz
+    values of A_product_func as nodes and the squared first components of
+    the Ritz vectors as weights. Returns [probe_num, m] nodes and weights;
+    missing entries of probes that stopped early have zero weight.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    iteration_num = min(iteration_num, v_like.shape[0])
+    nodes = torch.zeros((probe_num, iteration_num), dtype=torch.float64)
+    weights = torch.zeros((probe_num, iteration_num), dtype=torch.float64)
+    for i in range(probe_num):
+        probe = (
+            torch.randint(0, 2, v_like.shape, generator=generator) * 2 - 1
+        ).to(dtype=v_like.dtype, device=v_like.device)
+        alphas, betas, _ = lanczos(
+            A_product_func, probe, iteration_num, reorthogonalization)
+        ritz_values, S = _eigh_tridiagonal(alphas, betas)
+        nodes[i, : len(alphas)] = ritz_values
+        weights[i, : len(alphas)] = S[0] ** 2
+    return nodes, weights
+
+
+def smooth_spectral_density(nodes, weights, grid, sigma):
+    """
+    Evaluate the spectral density from get_spectral_density on grid by
+    replacing every node with a Gaussian of width sigma.
+    """
+    grid = grid.to(torch.float64).view(-1, 1, 1)
+    kernel = torch.exp(-((grid - nodes) ** 2) / (2 * sigma ** 2)) / (
+        sigma * math.sqrt(2 * math.pi)
+    )
+    return (kernel * weights).sum(dim=2).mean(dim=1)
+
+
+def get_hessian_eigenpairs(validator, k=1, which="largest", seed=0, **kwargs):
+    v0 = _get_start_vector(validator.model, seed)
+    return lanczos_eigenpairs(
+        validator.hessian_vector_product, v0, k, which, **kwargs)
+
+
+def get_hessian_spectral_density(validator, seed=0, **kwargs):
+    return get_spectral_density(
+        validator.hessian_vector_product,
+        _get_start_vector(validator.model, seed),
+        seed=seed,
+        **kwargs
+    )
+
+
+def _get_start_vector(model, seed):
+    parameters = model_parameters_to_vector(model)
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(
+        parameters.shape, generator=generator, dtype=parameters.dtype
+    ).to(get_device())
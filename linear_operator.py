@@ -0,0 +1,137 @@
+import torch
+
+from .device import get_device
+from .util import model_parameters_to_vector
+
+
+class LinearOperator:
+    """
+    A square matrix-free operator of the given size. Calling it with a
+    vector applies the operator, writing into out when given; calling it
+    with a [m, size] matrix applies it to every row. application_num counts
+    the vectors the operator has been applied to.
+    """
+
+    def __init__(self, size, dtype=torch.float32, device=None):
+        self.size = size
+        self.dtype = dtype
+        self.device = device if device is not None else get_device()
+        self.application_num = 0
+
+    def __call__(self, v, out=None):
+        if v.dim() == 2:
+            self.application_num += v.shape[0]
+            return self.matmat(v)
+        self.application_num += 1
+        return self.matvec(v, out)
+
+    def matvec(self, v, out=None):
+        raise NotImplementedError()
+
+    def matmat(self, V):
+        return torch.stack([self.matvec(v) for v in V])
+
+    def get_diagonal(self):
+        raise NotImplementedError()
+
+
+def _to_out(result, out):
+    if out is None:
+        return result
+    out.copy_(result)
+    return out
+
+
+class DenseOperator(LinearOperator):
+    def __init__(self, matrix):
+        super().__init__(matrix.shape[0], matrix.dtype, matrix.device)
+        self.matrix = matrix
+
+    def matvec(self, v, out=None):
+        return torch.mv(self.matrix, v, out=out)
+
+    def matmat(self, V):
+        return V @ self.matrix.T
+
+    def get_diagonal(self):
+        return self.matrix.diagonal()
+
+
+class FunctionOperator(LinearOperator):
+    def __init__(
+        self, product_func, size, dtype=torch.float32, device=None, products_func=None,
+    ):
+        # products_func optionally applies the operator to a batch of rows
+        super().__init__(size, dtype, device)
+        self.product_func = product_func
+        self.products_func = products_func
+
+    def matvec(self, v, out=None):
+        return _to_out(self.product_func(v), out)
+
+    def matmat(self, V):
+        if self.products_func is not None:
+            return self.products_func(V)
+        return super().matmat(V)
+
+
+class HessianOperator(FunctionOperator):
+    def __init__(self, validator, chunk_size=None):
+        # the Hessian of the whole dataset of validator
+        parameters = model_parameters_to_vector(validator.model)
+        super().__init__(
+            validator.hessian_vector_product,
+            parameters.shape[0],
+            parameters.dtype,
+            products_func=lambda V: validator.hessian_vector_products(
+                V, chunk_size=chunk_size
+            ),
+        )
+
+
+class ShiftedOperator(LinearOperator):
+    def __init__(self, operator, shift):
+        # operator + shift * I, e.g. a damped Hessian
+        super().__init__(operator.size, operator.dtype, operator.device)
+        self.operator = operator
+        self.shift = shift
+
+    def matvec(self, v, out=None):
+        out = self.operator(v, out=out)
+        if self.shift != 0:
+            out.add_(v, alpha=self.shift)
+        return out
+
+    def matmat(self, V):
+        res = self.operator(V)
+        if self.shift != 0:
+            res.add_(V, alpha=self.shift)
+        return res
+
+    def get_diagonal(self):
+        return self.operator.get_diagonal() + self.shift
+
+
+class ComposedOperator(LinearOperator):
+    def __init__(self, *operators):
+        # the product operators[0] @ operators[1] @ ..., applied right to left
+        super().__init__(operators[0].size, operators[0].dtype, operators[0].device)
+        self.operators = operators
+        self.__workspaces = None
+
+    def matvec(self, v, out=None):
+        if self.__workspaces is None:
+            self.__workspaces = [
+                torch.empty(op.size, dtype=op.dtype, device=op.device)
+                for op in self.operators[1:]
+            ]
+        for operator, workspace in zip(
+            reversed(self.operators[1:]), reversed(self.__workspaces)
+        ):
+            v = operator(v, out=workspace)
+        return self.operators[0](v, out=out)
+
+    def matmat(self, V):
+        for operator in reversed(self.operators):
+            V = operator(V)
+        return V
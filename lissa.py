@@ -0,0 +1,93 @@
+import torch
+
+from .device import get_device
+from .hessian_vector_product import hessian_vector_product
+from .solver import SolverInfo, get_tolerance
+
+
+def get_sampled_hessian_vector_product_func(
+    model, loss_fun, dataset, batch_size=64, seed=0
+):
+    """
+    Return a function computing H @ v on a fresh mini-batch sampled with
+    replacement from dataset on every call. The sequence of batches only
+    depends on seed.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    device = get_device()
+
+    def product_func(v):
+        indices = torch.randint(
+            len(dataset), (batch_size,), generator=generator).tolist()
+        inputs, targets = next(
+            iter(
+                torch.utils.data.DataLoader(
+                    torch.utils.data.Subset(dataset, indices),
+                    batch_size=batch_size,
+                )
+            )
+        )
+        model.eval()
+        model.to(device)
+        loss = loss_fun(
+            model(inputs.to(device, non_blocking=True)),
+            targets.to(device, non_blocking=True),
+        )
+        return hessian_vector_product(model, loss, v)
+
+    return product_func
+
+
+def lissa_general(
+    A_product_func,
+    b,
+    max_iteration=None,
+    epsilon=0.0001,
+    x0=None,
+    rtol=0,
+    damping=0,
+    scale=10,
+    repeat_num=1,
+    return_info=False,
+):
+    """
+    Estimate (A + damping * I)^-1 b with the LiSSA recursion
+        h_j = b + h_{j-1} - (A + damping * I) h_{j-1} / scale,
+    where every call of A_product_func may use a different mini-batch, see
+    get_sampled_hessian_vector_product_func. h / scale converges when scale
+    exceeds the largest eigenvalue of A + damping * I. max_iteration is the
+    recursion depth of each of the repeat_num averaged estimates and
+    defaults to 1000, independent of the problem size as in Agarwal et al.;
+    the recursion needs about scale / lambda_min steps. The residual of a
+    stochastic operator is noise, so the stopping rule and
+    SolverInfo.residual_norms use the norm of the change of x per step.
+    """
+    if max_iteration is None:
+        max_iteration = 1000
+    tolerance = get_tolerance(b, rtol, epsilon)
+    info = SolverInfo()
+    x_sum = None
+    for _ in range(repeat_num):
+        if x0 is None:
+            h = b.clone()
+        else:
+            h = x0.to(device=b.device, dtype=b.dtype) * scale
+        for _ in range(max_iteration):
+            product = A_product_func(h)
+            if damping != 0:
+                product += damping * h
+            update = b - product / scale
+            h += update
+            info.iteration_num += 1
+            info.residual_norms.append(torch.linalg.norm(update).item() / scale)
+            if info.residual_norms[-1] <= tolerance:
+                break
+        if x_sum is None:
+            x_sum = h / scale
+        else:
+            x_sum += h / scale
+    info.converged = bool(info.residual_norms) and info.residual_norms[-1] <= tolerance
+    x = x_sum / repeat_num
+    if return_info:
+        return x, info
+    return x
@@ -0,0 +1,119 @@
+import copy
+
+import torch
+
+
+def get_instance_losses(loss_fun, outputs, targets):
+    if hasattr(loss_fun, "reduction"):
+        # use a shallow copy so that other users of loss_fun, e.g. a
+        # training loop running concurrently, keep their reduction
+        instance_loss_fun = copy.copy(loss_fun)
+        instance_loss_fun.reduction = "none"
+        return instance_loss_fun(outputs, targets)
+    return torch.stack(
+        [loss_fun(output, target) for output, target in zip(outputs, targets)]
+    )
+
+
+class ClassificationMetrics:
+    def __init__(
+        self,
+        per_class_accuracy=False,
+        instance_num=None,
+        top_k=None,
+        confusion_matrix=False,
+    ):
+        self.per_class_accuracy = per_class_accuracy
+        self.instance_num = instance_num
+        self.top_k = top_k
+        self.confusion_matrix = confusion_matrix
+        self.num_correct = None
+        self.num_examples = 0
+        self.class_count = None
+        self.class_correct_count = None
+        self.top_k_correct_count = None
+        self.instance_losses = None
+        self.confusion = None
+
+    def update(self, outputs, targets, instance_indices=None, instance_losses=None):
+        outputs = outputs.detach()
+        targets = targets.view(-1)
+        class_num = outputs.shape[-1]
+        device = outputs.device
+        if self.num_correct is None:
+            self.num_correct = torch.zeros((), dtype=torch.long, device=device)
+        predictions = torch.argmax(outputs, dim=1).view(-1)
+        correct = torch.eq(predictions, targets)
+        self.num_correct += torch.sum(correct)
+        self.num_examples += targets.shape[0]
+
+        if self.per_class_accuracy:
+            class_count = torch.bincount(targets, minlength=class_num)
+            class_correct_count = torch.bincount(
+                targets[correct], minlength=class_num)
+            if self.class_count is None:
+                self.class_count = class_count
+                self.class_correct_count = class_correct_count
+            else:
+                self.class_count += class_count
+                self.class_correct_count += class_correct_count
+
+        if self.confusion_matrix:
+            confusion = torch.bincount(
+                targets * class_num + predictions, minlength=class_num * class_num
+            ).view(class_num, class_num)
+            if self.confusion is None:
+                self.confusion = confusion
+            else:
+                self.confusion += confusion
+
+        if self.top_k:
+            max_k = min(max(self.top_k), class_num)
+            top_k_hit = torch.eq(
+                torch.topk(outputs, max_k, dim=1).indices, targets.view(-1, 1)
+            )
+            top_k_correct_count = torch.stack(
+                [top_k_hit[:, : min(k, max_k)].any(dim=1).sum()
+                 for k in self.top_k]
+            )
+            if self.top_k_correct_count is None:
+                self.top_k_correct_count = top_k_correct_count
+            else:
+                self.top_k_correct_count += top_k_correct_count
+
+        if self.instance_num is not None and instance_losses is not None:
+            if self.instance_losses is None:
+                self.instance_losses = torch.full(
+                    (self.instance_num,), float("nan"), device=device
+                )
+            self.instance_losses[instance_indices.to(device)] = (
+                instance_losses.detach().float()
+            )
+
+    def get_accuracy(self):
+        if self.num_examples == 0:
+            return 0
+        return self.num_correct.item() / self.num_examples
+
+    def get_results(self):
+        results = {
+            "per_class_accuracy": dict(),
+            "per_class_count": dict(),
+            "per_instance_loss": self.instance_losses,
+        }
+        if self.class_count is not None:
+            class_count = self.class_count.tolist()
+            class_correct_count = self.class_correct_count.tolist()
+            for k, count in enumerate(class_count):
+                if count == 0:
+                    continue
+                results["per_class_accuracy"][k] = class_correct_count[k] / count
+                results["per_class_count"][k] = count
+        if self.top_k_correct_count is not None:
+            results["top_k_accuracy"] = {
+                k: count / self.num_examples
+                for k, count in zip(self.top_k, self.top_k_correct_count.tolist())
+            }
+        if self.confusion is not None:
+            results["confusion_matrix"] = self.confusion
+        return results
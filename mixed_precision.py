@@ -0,0 +1,61 @@
+import contextlib
+
+import torch
+
+
+class MixedPrecision:
+    """
+    Parameters stay in float32; only the forward pass and the loss run
+    under autocast with the chosen dtype.
+    """
+
+    dtypes = {
+        None: None,
+        "float32": None,
+        "bfloat16": torch.bfloat16,
+        "float16": torch.float16,
+    }
+
+    def __init__(self, precision, device):
+        if precision not in MixedPrecision.dtypes:
+            raise NotImplementedError(precision)
+        self.dtype = MixedPrecision.dtypes[precision]
+        self.device = device
+        self.scaler = None
+        if self.dtype == torch.float16:
+            if hasattr(torch.amp, "GradScaler"):
+                self.scaler = torch.amp.GradScaler(device.type)
+            else:
+                self.scaler = torch.cuda.amp.GradScaler(
+                    enabled=(device.type == "cuda"))
+
+    def autocast(self):
+        if self.dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.dtype)
+
+    def get_scale(self):
+        if self.scaler is None or not self.scaler.is_enabled():
+            return 1
+        # the scaler creates its scale tensor on the first scale call
+        self.scaler.scale(torch.zeros((), device=self.device))
+        return self.scaler.get_scale()
+
+    def scale(self, tensor):
+        if self.scaler is None:
+            return tensor
+        return self.scaler.scale(tensor)
+
+    def backward(self, loss):
+        self.scale(loss).backward()
+
+    def unscale(self, optimizer):
+        if self.scaler is not None:
+            self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        if self.scaler is None:
+            optimizer.step()
+            return
+        self.scaler.step(optimizer)
+        self.scaler.update()
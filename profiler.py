@@ -0,0 +1,146 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+import torch
+
+
+class Profiler:
+    def __init__(self, synchronize=False, record_trace=False):
+        self.synchronize = synchronize
+        self.record_trace = record_trace
+        self.epoch_records = []
+        self.__phases = dict()
+        self.__trace_events = []
+        self.__epoch_begin_time = None
+        self.__peak_memory = 0
+        self.__pending_epoch_phases = dict()
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.__synchronize()
+        begin_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__synchronize()
+            self.__record(name, begin_time, time.perf_counter())
+
+    def iterate(self, iterable, name="data_loading"):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def begin_epoch(self):
+        with self.__lock:
+            self.__phases = dict()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.__peak_memory = get_memory_usage()
+        self.__epoch_begin_time = time.perf_counter()
+
+    def end_epoch(self, epoch, sample_num=None):
+        self.__synchronize()
+        wall_time = time.perf_counter() - self.__epoch_begin_time
+        with self.__lock:
+            phases = self.__phases
+            self.__phases = dict()
+        record = {
+            "epoch": epoch,
+            "wall_time": wall_time,
+            "sample_num": sample_num,
+            "throughput": None,
+            "phases": phases,
+            "peak_memory": self.get_peak_memory(),
+        }
+        if sample_num:
+            record["throughput"] = sample_num / wall_time
+        with self.__lock:
+            record.update(self.__pending_epoch_phases.pop(epoch, dict()))
+            self.epoch_records.append(record)
+        return record
+
+    def add_epoch_phases(self, epoch, name, profiler):
+        """
+        Attach the phases of profiler, e.g. of work for epoch that runs on
+        another thread past the end of the epoch, to the record of epoch
+        under name.
+        """
+        with profiler.__lock:
+            phases = dict(profiler.__phases)
+            trace_events = list(profiler.__trace_events)
+        with self.__lock:
+            self.__trace_events.extend(trace_events)
+            for record in self.epoch_records:
+                if record["epoch"] == epoch:
+                    record[name] = phases
+                    return
+            self.__pending_epoch_phases.setdefault(epoch, dict())[name] = phases
+
+    def export_chrome_trace(self, path):
+        with self.__lock:
+            events = list(self.__trace_events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+    def get_peak_memory(self):
+        # the peak since begin_epoch; on CPU the resident set size is sampled
+        # at the end of every phase
+        if torch.cuda.is_available():
+            return {"cuda": torch.cuda.max_memory_allocated()}
+        return {"cpu": self.__peak_memory}
+
+    def __synchronize(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def __record(self, name, begin_time, end_time):
+        memory = 0 if torch.cuda.is_available() else get_memory_usage()
+        with self.__lock:
+            self.__peak_memory = max(self.__peak_memory, memory)
+            phase = self.__phases.setdefault(name, {"time": 0.0, "count": 0})
+            phase["time"] += end_time - begin_time
+            phase["count"] += 1
+            if self.record_trace:
+                self.__trace_events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": begin_time * 1e6,
+                        "dur": (end_time - begin_time) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+
+def get_memory_usage():
+    # allocated CUDA memory, or the current resident set size of the process
+    if torch.cuda.is_available():
+        return torch.cuda.memory_allocated()
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # ru_maxrss is the peak of the whole process, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def profile_phase(profiler, name):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+
+def profile_iteration(profiler, iterable, name="data_loading"):
+    if profiler is None:
+        return iterable
+    return profiler.iterate(iterable, name)
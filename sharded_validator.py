@@ -0,0 +1,236 @@
+import copy
+import os
+import traceback
+
+import torch
+import torch.multiprocessing
+
+from .checkpoint import clone_state
+from .validator import Validator
+
+
+def _worker(conn, model, loss_fun, dataset, thread_num):
+    torch.set_num_threads(thread_num)
+    validator = Validator(model, loss_fun, dataset, share_model=True)
+    while True:
+        command, state_dict, args = conn.recv()
+        if command == "stop":
+            break
+        try:
+            validator.model.load_state_dict(state_dict)
+            if command == "validate":
+                batch_size, kwargs = args
+                result = validator.validate(batch_size, **kwargs)
+            elif command == "get_gradient":
+                result = validator.get_gradient()
+            elif command == "hessian_vector_product":
+                result = validator.hessian_vector_product(
+                    args.to(next(validator.model.parameters()).device))
+            elif command == "hessian_vector_products":
+                vectors, chunk_size = args
+                result = validator.hessian_vector_products(
+                    vectors.to(next(validator.model.parameters()).device),
+                    chunk_size=chunk_size,
+                )
+            else:
+                raise NotImplementedError(command)
+            conn.send((True, clone_state(result)))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+
+class ShardedValidator:
+    def __init__(self, model, loss_fun, dataset, worker_num=2, batch_size=64):
+        # shards are contiguous and aligned to batch_size, so every worker
+        # sees the same batches as a serial Validator with that batch size
+        self.model = model
+        self.loss_fun = loss_fun
+        self.dataset = dataset
+        self.batch_size = batch_size
+        batch_num = (len(dataset) + batch_size - 1) // batch_size
+        worker_num = max(1, min(worker_num, batch_num))
+        self.shard_ranges = []
+        for i in range(worker_num):
+            begin = min(len(dataset), (batch_num * i // worker_num) * batch_size)
+            end = min(
+                len(dataset), (batch_num * (i + 1) // worker_num) * batch_size)
+            self.shard_ranges.append((begin, end))
+
+        thread_num = max(1, (os.cpu_count() or 1) // worker_num)
+        ctx = torch.multiprocessing.get_context("spawn")
+        cpu_model = copy.deepcopy(model).cpu()
+        self.__connections = []
+        self.__processes = []
+        for begin, end in self.shard_ranges:
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                args=(
+                    child_conn,
+                    cpu_model,
+                    loss_fun,
+                    torch.utils.data.Subset(dataset, range(begin, end)),
+                    thread_num,
+                ),
+            )
+            process.start()
+            self.__connections.append(parent_conn)
+            self.__processes.append(process)
+
+    def validate(self, batch_size=None, **kwargs):
+        if batch_size is None:
+            batch_size = self.batch_size
+        results = self.__run("validate", (batch_size, kwargs))
+        weights = self.__get_weights()
+        loss = sum(w * result[0] for w, result in zip(weights, results))
+        accuracy = sum(
+            (end - begin) * result[1]
+            for (begin, end), result in zip(self.shard_ranges, results)
+        ) / len(self.dataset)
+
+        other_data = {
+            "per_class_accuracy": dict(),
+            "per_class_count": dict(),
+            "per_instance_loss": None,
+        }
+        for _, _, shard_data in results:
+            for k, count in shard_data["per_class_count"].items():
+                other_data["per_class_count"][k] = (
+                    other_data["per_class_count"].get(k, 0) + count
+                )
+                other_data["per_class_accuracy"][k] = (
+                    other_data["per_class_accuracy"].get(k, 0)
+                    + shard_data["per_class_accuracy"][k] * count
+                )
+        for k, count in other_data["per_class_count"].items():
+            other_data["per_class_accuracy"][k] /= count
+        if kwargs.get("per_instance_loss", False):
+            other_data["per_instance_loss"] = torch.cat(
+                [shard_data["per_instance_loss"] for _, _, shard_data in results]
+            )
+        if kwargs.get("top_k", None):
+            other_data["top_k_accuracy"] = {
+                k: sum(
+                    (end - begin) * shard_data["top_k_accuracy"][k]
+                    for (begin, end), (_, _, shard_data) in zip(
+                        self.shard_ranges, results
+                    )
+                )
+                / len(self.dataset)
+                for k in kwargs["top_k"]
+            }
+        if kwargs.get("confusion_matrix", False):
+            other_data["confusion_matrix"] = self.__sum_padded(
+                [shard_data["confusion_matrix"] for _, _, shard_data in results]
+            )
+        return loss, accuracy, other_data
+
+    def get_gradient(self):
+        # the serial gradient is a plain sum over the batches, see
+        # Validator.get_gradient, and shards are aligned to batches
+        return sum(self.__run("get_gradient", None))
+
+    def hessian_vector_product(self, v, damping=0):
+        res = self.__reduce(
+            self.__run("hessian_vector_product", v.detach().cpu()))
+        res = res.to(v.device)
+        if damping != 0:
+            res += damping * v
+        return res
+
+    def hessian_vector_products(self, vectors, damping=0, chunk_size=None):
+        res = self.__reduce(
+            self.__run(
+                "hessian_vector_products", (vectors.detach().cpu(), chunk_size)
+            )
+        )
+        res = res.to(vectors.device)
+        if damping != 0:
+            res += damping * vectors
+        return res
+
+    def stop(self):
+        for conn in self.__connections:
+            conn.send(("stop", None, None))
+        for process in self.__processes:
+            process.join()
+        self.__connections = []
+        self.__processes = []
+
+    def __run(self, command, args):
+        # only the current weights and the arguments are sent on each call
+        state_dict = clone_state(self.model.state_dict())
+        for conn in self.__connections:
+            conn.send((command, state_dict, args))
+        results = []
+        for conn in self.__connections:
+            success, result = conn.recv()
+            if not success:
+                raise RuntimeError(result)
+            results.append(result)
+        return results
+
+    def __get_weights(self):
+        # each shard normalizes mean losses, and so the losses of the HVPs,
+        # by its own size
+        if hasattr(self.loss_fun, "reduction") and (
+            self.loss_fun.reduction == "mean"
+            or self.loss_fun.reduction == "elementwise_mean"
+        ):
+            return [
+                (end - begin) / len(self.dataset) for begin, end in self.shard_ranges
+            ]
+        return [1] * len(self.shard_ranges)
+
+    def __reduce(self, results):
+        return sum(w * result for w, result in zip(self.__get_weights(), results))
+
+    @staticmethod
+    def __sum_padded(matrices):
+        size = max(matrix.shape[0] for matrix in matrices)
+        total = torch.zeros((size, size), dtype=matrices[0].dtype)
+        for matrix in matrices:
+            total[: matrix.shape[0], : matrix.shape[1]] += matrix
+        return total
+
+
+if __name__ == "__main__":
+    from .model import LeNet5
+
+    torch.manual_seed(0)
+    test_model = LeNet5()
+    test_loss_fun = torch.nn.CrossEntropyLoss()
+    test_dataset = torch.utils.data.TensorDataset(
+        torch.randn(300, 1, 32, 32), torch.randint(0, 10, (300,))
+    )
+    serial_validator = Validator(test_model, test_loss_fun, test_dataset)
+    sharded_validator = ShardedValidator(
+        test_model, test_loss_fun, test_dataset, worker_num=2, batch_size=64
+    )
+    test_v = torch.randn_like(serial_validator.get_gradient())
+    for name, serial_result, sharded_result in [
+        (
+            "validation loss",
+            serial_validator.validate(64)[0],
+            sharded_validator.validate(64)[0],
+        ),
+        (
+            "gradient",
+            serial_validator.get_gradient(),
+            sharded_validator.get_gradient(),
+        ),
+        (
+            "hessian vector product",
+            serial_validator.hessian_vector_product(test_v),
+            sharded_validator.hessian_vector_product(test_v),
+        ),
+    ]:
+        serial_result = serial_result.cpu()
+        sharded_result = sharded_result.cpu()
+        print(
+            name,
+            torch.allclose(serial_result, sharded_result, rtol=1e-4, atol=1e-6),
+            (torch.linalg.norm(serial_result - sharded_result)
+             / torch.linalg.norm(serial_result)).item(),
+        )
+    sharded_validator.stop()
@@ -0,0 +1,85 @@
+import torch
+
+from .linear_operator import LinearOperator
+
+
+class SolverInfo:
+    def __init__(self):
+        self.iteration_num = 0
+        self.residual_norms = []
+        self.converged = False
+
+    def __repr__(self):
+        return "SolverInfo(iteration_num={}, residual_norm={}, converged={})".format(
+            self.iteration_num,
+            self.residual_norms[-1] if self.residual_norms else None,
+            self.converged,
+        )
+
+
+class ResidualHistory:
+    """
+    The residual norms of an iterative solver. Norms are recorded on the
+    device and only copied to the host list residual_norms by flush, so a
+    solver synchronizes once per check instead of every iteration.
+    """
+
+    def __init__(self, r, check_interval):
+        self.residual_norms = [torch.linalg.norm(r).item()]
+        self.__buffer = torch.empty(
+            check_interval, dtype=r.dtype, device=r.device)
+        self.__size = 0
+
+    def record(self, r):
+        if self.__size == self.__buffer.shape[0]:
+            self.flush()
+        self.__buffer[self.__size] = torch.linalg.norm(r)
+        self.__size += 1
+
+    def flush(self):
+        # returns the last residual norm
+        if self.__size:
+            self.residual_norms += self.__buffer[: self.__size].tolist()
+            self.__size = 0
+        return self.residual_norms[-1]
+
+
+def get_jacobi_preconditioner(diagonal, epsilon=1e-8):
+    # diagonal entries close to zero are clamped to keep the inverse bounded
+    inverse_diagonal = 1 / torch.where(
+        diagonal.abs() < epsilon,
+        torch.full_like(diagonal, epsilon),
+        diagonal,
+    )
+    return lambda r: inverse_diagonal * r
+
+
+def get_initial_guess(b, x0=None, dtype=None):
+    if dtype is None:
+        dtype = b.dtype
+    if x0 is None:
+        return torch.ones(b.shape, dtype=dtype, device=b.device)
+    return x0.to(device=b.device, dtype=dtype, copy=True)
+
+
+def get_tolerance(b, rtol, atol):
+    return max(rtol * torch.linalg.norm(b).item(), atol)
+
+
+def apply_operator(A_product_func, v, out, operator_dtype):
+    # products are computed in operator_dtype and written into out, without
+    # allocations when A_product_func is a LinearOperator of matching dtype
+    if v.dtype != operator_dtype:
+        v = v.to(operator_dtype)
+    if isinstance(A_product_func, LinearOperator) and out.dtype == operator_dtype:
+        return A_product_func(v, out=out)
+    out.copy_(A_product_func(v))
+    return out
+
+
+def safe_divide(numerator, denominator):
+    # stays on the device; a zero denominator only occurs once the residual
+    # vanished between two convergence checks
+    return torch.where(
+        denominator != 0, numerator / denominator, torch.zeros_like(numerator)
+    )
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import threading
+import time
+
+import torch
+import torch.nn as nn
+
+from .conjugate_gradient import conjugate_gradient_general
+from .device import get_device
+from .hessian_vector_product import hessian_vector_product
+from .linear_operator import (
+    DenseOperator,
+    FunctionOperator,
+    HessianOperator,
+    ShiftedOperator,
+)
+from .log import get_logger
+from .model import LeNet5
+from .profiler import get_memory_usage
+from .solver import get_jacobi_preconditioner
+from .steepest_descent import steepest_descent_general
+from .util import model_parameters_to_vector, parameters_to_vector
+from .validator import Validator
+
+
+def get_spd_problem(size, condition_number, seed=0, dtype=torch.float64):
+    """
+    Return a DenseOperator for a random SPD matrix whose eigenvalues are
+    spaced logarithmically between 1 and condition_number, and a right-hand
+    side.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    Q, _ = torch.linalg.qr(torch.randn(size, size, generator=generator, dtype=dtype))
+    eigenvalues = torch.logspace(
+        0, torch.log10(torch.tensor(float(condition_number))).item(), size, dtype=dtype
+    )
+    A = (Q * eigenvalues) @ Q.T
+    b = torch.randn(size, generator=generator, dtype=dtype)
+    device = get_device()
+    return DenseOperator(A.to(device)), b.to(device)
+
+
+def get_lenet5_hessian_problem(sample_num=64, damping=1.0, seed=0):
+    """
+    Return the damped Hessian of a LeNet5 cross entropy loss and the loss
+    gradient as right-hand side. The inputs and targets are random tensors,
+    not a dataset, so the problem needs no download; use
+    get_dataset_hessian_problem for a real dataset. The Hessian of a ReLU
+    network can be indefinite, damping shifts its spectrum; at the default
+    initialization its smallest eigenvalue is about -0.8.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    device = get_device()
+    model = LeNet5().to(device)
+    inputs = torch.randn(sample_num, 1, 32, 32, generator=generator).to(device)
+    targets = torch.randint(0, 10, (sample_num,), generator=generator).to(device)
+    loss = nn.CrossEntropyLoss()(model(inputs), targets)
+    b = parameters_to_vector(
+        torch.autograd.grad(loss, model.parameters(), retain_graph=True)
+    ).detach()
+    operator = FunctionOperator(
+        lambda v: hessian_vector_product(model, loss, v),
+        model_parameters_to_vector(model).shape[0],
+        b.dtype,
+        device,
+    )
+    return ShiftedOperator(operator, damping), b
+
+
+def get_dataset_hessian_problem(model, loss_fun, dataset, damping=1.0):
+    """
+    Return the damped Hessian of the loss of model over dataset and the
+    dataset gradient as right-hand side; every application is one pass
+    over dataset.
+    """
+    validator = Validator(model, loss_fun, dataset)
+    return (
+        ShiftedOperator(HessianOperator(validator), damping),
+        validator.get_gradient().detach(),
+    )
+
+
+class _MemorySampler:
+    # samples get_memory_usage on a background thread, torch kernels release
+    # the GIL so the samples interleave with the solver
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.base_memory = 0
+        self.peak_memory = 0
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.base_memory = get_memory_usage()
+        self.peak_memory = self.base_memory
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__thread.join()
+        if torch.cuda.is_available():
+            self.peak_memory = torch.cuda.max_memory_allocated()
+        else:
+            self.peak_memory = max(self.peak_memory, get_memory_usage())
+        return self.peak_memory - self.base_memory
+
+    def __sample(self):
+        while not self.__stop_event.wait(self.interval):
+            self.peak_memory = max(self.peak_memory, get_memory_usage())
+
+
+def jacobi_conjugate_gradient(A_product_func, b, **kwargs):
+    return conjugate_gradient_general(
+        A_product_func,
+        b,
+        preconditioner=get_jacobi_preconditioner(A_product_func.get_diagonal()),
+        **kwargs
+    )
+
+
+class SolverBenchmark:
+    def __init__(self):
+        self.problems = dict()
+        # solver(A_product_func, b, max_iteration=, epsilon=, x0=, rtol=,
+        # return_info=True, **kwargs) returns x and a SolverInfo; all
+        # solvers start from zero
+        self.solvers = {
+            "steepest_descent": (steepest_descent_general, dict()),
+            "conjugate_gradient": (conjugate_gradient_general, dict()),
+            "jacobi_conjugate_gradient": (jacobi_conjugate_gradient, dict()),
+        }
+        self.results = []
+
+    def add_problem(self, name, operator, b, max_iteration=None, rtol=1e-6):
+        self.problems[name] = (operator, b, max_iteration, rtol)
+
+    def add_solver(self, name, solver, **kwargs):
+        self.solvers[name] = (solver, kwargs)
+
+    def add_default_problems(self):
+        for size, condition_number in [(100, 1e2), (500, 1e4), (1000, 1e6)]:
+            operator, b = get_spd_problem(size, condition_number)
+            self.add_problem(
+                "spd_{}_cond_{:g}".format(size, condition_number), operator, b
+            )
+        operator, b = get_lenet5_hessian_problem()
+        self.add_problem("lenet5_hessian", operator, b, max_iteration=100, rtol=1e-4)
+
+    def run(self):
+        self.results = []
+        for problem_name, (operator, b, max_iteration, rtol) in self.problems.items():
+            for solver_name, (solver, kwargs) in self.solvers.items():
+                try:
+                    result = self.__run_solver(
+                        solver, kwargs, operator, b, max_iteration, rtol)
+                except NotImplementedError:
+                    # e.g. a Jacobi preconditioner without an operator diagonal
+                    get_logger().warning(
+                        "%s doesn't support %s", solver_name, problem_name)
+                    continue
+                result["problem"] = problem_name
+                result["solver"] = solver_name
+                get_logger().info(
+                    "%s on %s: %s applications, %.3fs, converged %s",
+                    solver_name,
+                    problem_name,
+                    result["application_num"],
+                    result["wall_time"],
+                    result["converged"],
+                )
+                self.results.append(result)
+        return self.results
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.results, f, indent=2)
+
+    def compare(self, baseline_path, time_tolerance=0.2, memory_tolerance=0.2):
+        """
+        Compare the results with those stored at baseline_path and return
+        the regressions: solvers that stopped converging or need more
+        operator applications, more than (1 + time_tolerance) times the
+        baseline wall time or more than (1 + memory_tolerance) times the
+        baseline peak memory growth plus 1MB of sampling noise.
+        """
+        with open(baseline_path) as f:
+            baseline = {
+                (result["problem"], result["solver"]): result for result in json.load(f)
+            }
+        regressions = []
+        for result in self.results:
+            old_result = baseline.get((result["problem"], result["solver"]))
+            if old_result is None:
+                continue
+            reasons = []
+            if old_result["converged"] and not result["converged"]:
+                reasons.append("no longer converges")
+            if result["application_num"] > old_result["application_num"]:
+                reasons.append(
+                    "applications {} -> {}".format(
+                        old_result["application_num"], result["application_num"]
+                    )
+                )
+            if result["wall_time"] > (1 + time_tolerance) * old_result["wall_time"]:
+                reasons.append(
+                    "wall time {:.3f}s -> {:.3f}s".format(
+                        old_result["wall_time"], result["wall_time"]
+                    )
+                )
+            if result["peak_memory"] > (1 + memory_tolerance) * old_result[
+                "peak_memory"
+            ] + 2 ** 20:
+                reasons.append(
+                    "peak memory {} -> {}".format(
+                        old_result["peak_memory"], result["peak_memory"]
+                    )
+                )
+            if reasons:
+                regressions.append(
+                    {
+                        "problem": result["problem"],
+                        "solver": result["solver"],
+                        "reasons": reasons,
+                    }
+                )
+        return regressions
+
+    @staticmethod
+    def __run_solver(solver, kwargs, operator, b, max_iteration, rtol):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        memory_sampler = _MemorySampler()
+        memory_sampler.start()
+        operator.application_num = 0
+        begin_time = time.perf_counter()
+        x, info = solver(
+            operator,
+            b,
+            max_iteration=max_iteration,
+            epsilon=0,
+            x0=torch.zeros_like(b),
+            rtol=rtol,
+            return_info=True,
+            **kwargs
+        )
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        wall_time = time.perf_counter() - begin_time
+        application_num = operator.application_num
+        # the growth over the memory in use before the run; on CPU allocator
+        # caching can hide allocations that reuse memory freed by earlier runs
+        peak_memory = memory_sampler.stop()
+        relative_residual = (
+            torch.linalg.norm(b - operator(x.to(b.dtype))) / torch.linalg.norm(b)
+        ).item()
+        return {
+            "wall_time": wall_time,
+            "application_num": application_num,
+            "iteration_num": info.iteration_num,
+            "converged": bool(info.converged),
+            "relative_residual": relative_residual,
+            "residual_norms": info.residual_norms,
+            "peak_memory": peak_memory,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="solver_benchmark.json")
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--time_tolerance", type=float, default=0.2)
+    parser.add_argument("--memory_tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    benchmark = SolverBenchmark()
+    benchmark.add_default_problems()
+    benchmark.run()
+    benchmark.save(args.output)
+    if args.baseline is not None:
+        for regression in benchmark.compare(
+            args.baseline, args.time_tolerance, args.memory_tolerance
+        ):
+            get_logger().warning(
+                "%s on %s: %s",
+                regression["solver"],
+                regression["problem"],
+                ", ".join(regression["reasons"]),
+            )
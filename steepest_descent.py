@@ -2,34 +2,71 @@
 
 import torch
 from .device import get_device
+from .linear_operator import DenseOperator, FunctionOperator
+from .solver import (
+    ResidualHistory,
+    SolverInfo,
+    apply_operator,
+    get_initial_guess,
+    get_tolerance,
+    safe_divide,
+)
 
 
-def steepest_descent(A, b, max_iteration=None, epsilon=0.0001):
-    return steepest_descent_general(lambda v: A @ v, b, max_iteration, epsilon)
+def steepest_descent(A, b, max_iteration=None, epsilon=0.0001, **kwargs):
+    return steepest_descent_general(
+        DenseOperator(A), b, max_iteration, epsilon, **kwargs)
 
 
 def steepest_descent_general(
     A_product_func,
     b,
     max_iteration=None,
-        epsilon=0.0001):
+    epsilon=0.0001,
+    x0=None,
+    preconditioner=None,
+    rtol=0,
+    residual_recompute_interval=50,
+    return_info=False,
+    dtype=None,
+    check_interval=10,
+):
+    """
+    Takes the same arguments as conjugate_gradient_general.
+    """
+    operator_dtype = b.dtype
+    if dtype is None:
+        dtype = b.dtype
     if max_iteration is None:
         max_iteration = b.shape[0]
-    x = torch.ones(b.shape)
-    x = x.to(get_device())
-    r = b - A_product_func(x)
-    delta = r @ r
+    tolerance = get_tolerance(b, rtol, epsilon)
+    info = SolverInfo()
+    b = b.to(dtype)
+    x = get_initial_guess(b, x0, dtype)
+    q = torch.empty_like(b)
+    r = apply_operator(A_product_func, x, torch.empty_like(b), operator_dtype)
+    r.neg_().add_(b)
+    residual_history = ResidualHistory(r, check_interval)
+    info.residual_norms = residual_history.residual_norms
+    info.converged = info.residual_norms[0] <= tolerance
     for i in range(max_iteration):
-        q = A_product_func(r)
-        alpha = delta / (r @ q)
-        x = x + alpha * r
-        if i % 50 == 0:
-            r = b - A_product_func(x)
-        else:
-            r = r - alpha * q
-        delta = r @ r
-        if torch.sqrt(delta) < epsilon:
+        if info.converged:
             break
+        z = r if preconditioner is None else preconditioner(r)
+        apply_operator(A_product_func, z, q, operator_dtype)
+        alpha = safe_divide(torch.dot(r, z), torch.dot(z, q))
+        x.addcmul_(z, alpha)
+        if residual_recompute_interval and (i + 1) % residual_recompute_interval == 0:
+            apply_operator(A_product_func, x, r, operator_dtype)
+            r.neg_().add_(b)
+        else:
+            r.addcmul_(q, alpha, value=-1)
+        info.iteration_num = i + 1
+        residual_history.record(r)
+        if (i + 1) % check_interval == 0 or i + 1 == max_iteration:
+            info.converged = residual_history.flush() <= tolerance
+    if return_info:
+        return x, info
     return x
 
 
@@ -41,3 +78,15 @@ if __name__ == "__main__":
     p = steepest_descent(test_A, test_b)
     print(test_A @ p)
     print(test_b)
+    # an SPD system through a FunctionOperator, accumulating in float64
+    spd_A = test_A @ test_A.T
+    p, info = steepest_descent_general(
+        FunctionOperator(lambda v: spd_A @ v, 2, test_b.dtype),
+        test_b,
+        max_iteration=100,
+        dtype=torch.float64,
+        check_interval=2,
+        return_info=True,
+    )
+    print(spd_A @ p.float())
+    print(info)
@@ -1,17 +1,32 @@
 import os
 
+import concurrent.futures
+import contextlib
 import copy
 import torch
 
+from .checkpoint import Checkpointer, get_rng_state, set_rng_state
+from .compiler import compile_model
 from .device import get_cpu_device
 from .device import get_device
+from .distributed import (
+    all_reduce_gradients,
+    all_reduce_sum,
+    broadcast_from_master,
+    is_distributed,
+    is_master,
+)
+from .gradient import get_per_instance_gradients
 from .util import (
+    accumulate_model_gradients,
     model_gradients_to_vector,
     model_parameters_to_vector,
     split_list_to_chunks,
 )
 from .validator import Validator
 from .log import get_logger
+from .mixed_precision import MixedPrecision
+from .profiler import Profiler, profile_iteration, profile_phase
 from .visualization import Window
 
 
@@ -25,6 +40,12 @@ class Trainer:
         self.__hyper_parameter = None
         self.__reset_hyper_parameter = False
         self.stop_criterion = None
+        self.precision = None
+        self.profiler = None
+        self.compile_model = False
+        self.__validation_executor = None
+        self.__pending_validations = dict()
+        self.__resume_state = None
         self.__reset_loss()
 
     def set_hyper_parameter(self, hyper_parameter):
@@ -35,6 +56,10 @@ class Trainer:
         return self.__hyper_parameter
 
     def train(self, **kwargs):
+        # logging, visualization and validation only run on the master process
+        if not is_master():
+            return self.__train(**kwargs)
+
         def pre_training_callback(trainer, optimizer, lr_scheduler):
             get_logger(
                 trainer.name).info(
@@ -65,7 +90,7 @@ class Trainer:
                     epoch,
                     batch_index,
                     learning_rates,
-                    batch_loss,
+                    batch_loss.item(),
                 )
 
         kwargs = Trainer.__prepend_callback(
@@ -76,6 +101,92 @@ class Trainer:
             "plot_parameter_distribution", False)
         plot_class_accuracy = kwargs.get("plot_class_accuracy", False)
 
+        validator = None
+
+        def get_validator(trainer):
+            nonlocal validator
+            if validator is None:
+                # synchronous validation borrows the live model, asynchronous
+                # validation reuses one shadow copy that the validation thread
+                # loads each weight snapshot into
+                validator = Validator(
+                    trainer.model,
+                    trainer.loss_fun,
+                    trainer.validation_dataset,
+                    share_model=not kwargs.get("async_validation", False),
+                )
+                validator.precision = trainer.precision
+                validator.profiler = trainer.profiler
+                validator.compile_model = trainer.compile_model
+                validator.num_workers = kwargs.get("validation_num_workers", 0)
+            return validator
+
+        def validate(trainer, validator, epoch, learning_rates):
+            validation_loss, accuracy, other_data = validator.validate(
+                kwargs.get("validation_batch_size", None),
+                per_class_accuracy=True,
+            )
+            validation_loss = validation_loss.data.item()
+            trainer.validation_loss[epoch] = validation_loss
+            trainer.validation_accuracy[epoch] = accuracy
+            get_logger(
+                trainer.name).info(
+                "epoch: %s, learning_rate: %s, validation loss: %s, accuracy = %s",
+                epoch,
+                learning_rates,
+                validation_loss,
+                accuracy,
+            )
+            Window.get("training & validation loss").plot_loss(
+                epoch, validation_loss, "validation loss"
+            )
+            Window.get("validation accuracy").plot_accuracy(
+                epoch, accuracy, "accuracy"
+            )
+
+            if plot_class_accuracy:
+                class_accuracy = other_data["per_class_accuracy"]
+                for idx, sub_list in enumerate(
+                    split_list_to_chunks(list(class_accuracy.keys()), 2)
+                ):
+                    class_accuracy_win = Window.get(
+                        "class accuracy part " + str(idx)
+                    )
+                    for k in sub_list:
+                        get_logger(
+                            trainer.name).info(
+                            "epoch: %s, learning_rate: %s, class %s accuracy = %s",
+                            epoch,
+                            learning_rates,
+                            k,
+                            class_accuracy[k],
+                        )
+                        class_accuracy_win.plot_accuracy(
+                            epoch,
+                            class_accuracy[k],
+                            "class_" + str(k) + "_accuracy",
+                        )
+
+        def validate_async(
+            trainer, validator, state_dict, epoch, learning_rates
+        ):
+            # the validation outlives its epoch, so its phases are collected
+            # separately and attached to the record of that epoch
+            with torch.no_grad():
+                validator.model.load_state_dict(state_dict)
+            if trainer.profiler is None:
+                validate(trainer, validator, epoch, learning_rates)
+                return
+            validator.profiler = Profiler(
+                trainer.profiler.synchronize, trainer.profiler.record_trace
+            )
+            try:
+                validate(trainer, validator, epoch, learning_rates)
+            finally:
+                trainer.profiler.add_epoch_phases(
+                    epoch, "validation_phases", validator.profiler
+                )
+
         def after_epoch_callback(trainer, epoch, learning_rates):
             nonlocal plot_parameter_distribution
             nonlocal plot_class_accuracy
@@ -100,47 +211,25 @@ class Trainer:
             validation_epoch_interval = int(
                 kwargs.get("validation_epoch_interval", 1))
             if epoch % validation_epoch_interval == 0:
-                validation_loss, accuracy, other_data = Validator(
-                    trainer.model, trainer.loss_fun, trainer.validation_dataset).validate(
-                    trainer.__hyper_parameter.batch_size, per_class_accuracy=True)
-                validation_loss = validation_loss.data.item()
-                trainer.validation_loss[epoch] = validation_loss
-                trainer.validation_accuracy[epoch] = accuracy
-                get_logger(
-                    trainer.name).info(
-                    "epoch: %s, learning_rate: %s, validation loss: %s, accuracy = %s",
-                    epoch,
-                    learning_rates,
-                    validation_loss,
-                    accuracy,
-                )
-                loss_win.plot_loss(epoch, validation_loss, "validation loss")
-                Window.get("validation accuracy").plot_accuracy(
-                    epoch, accuracy, "accuracy"
-                )
-
-                if plot_class_accuracy:
-                    class_accuracy = other_data["per_class_accuracy"]
-                    for idx, sub_list in enumerate(
-                        split_list_to_chunks(list(class_accuracy.keys()), 2)
-                    ):
-                        class_accuracy_win = Window.get(
-                            "class accuracy part " + str(idx)
-                        )
-                        for k in sub_list:
-                            get_logger(
-                                trainer.name).info(
-                                "epoch: %s, learning_rate: %s, class %s accuracy = %s",
-                                epoch,
-                                learning_rates,
-                                k,
-                                class_accuracy[k],
-                            )
-                            class_accuracy_win.plot_accuracy(
-                                epoch,
-                                class_accuracy[k],
-                                "class_" + str(k) + "_accuracy",
-                            )
+                if kwargs.get("async_validation", False):
+                    # a device copy of the weights is queued instead of
+                    # refreshing the shadow model here, which would have to
+                    # join a validation that is still running
+                    state_dict = {
+                        name: tensor.detach().clone()
+                        for name, tensor in trainer.model.state_dict().items()
+                    }
+                    trainer.__submit_validation(
+                        epoch,
+                        validate_async,
+                        trainer,
+                        get_validator(trainer),
+                        state_dict,
+                        epoch,
+                        learning_rates,
+                    )
+                else:
+                    validate(trainer, get_validator(trainer), epoch, learning_rates)
 
         kwargs = Trainer.__prepend_callback(
             kwargs, "after_epoch_callback", after_epoch_callback
@@ -149,25 +238,68 @@ class Trainer:
         return self.__train(**kwargs)
 
     def __train(self, **kwargs):
+        distributed = is_distributed()
+        training_sampler = None
+        if distributed:
+            training_sampler = torch.utils.data.distributed.DistributedSampler(
+                self.training_dataset, shuffle=True
+            )
         training_data_loader = torch.utils.data.DataLoader(
             self.training_dataset,
             batch_size=self.__hyper_parameter.batch_size,
-            shuffle=True,
+            shuffle=(training_sampler is None),
+            sampler=training_sampler,
         )
 
         training_set_size = len(self.training_dataset)
+        mean_reduction = hasattr(self.loss_fun, "reduction") and (
+            self.loss_fun.reduction == "mean"
+            or self.loss_fun.reduction == "elementwise_mean"
+        )
         batch_index = 0
         device = get_device()
         self.model.to(device)
+        forward_model = self.model
+        if distributed:
+            forward_model = torch.nn.parallel.DistributedDataParallel(
+                self.model, bucket_cap_mb=kwargs.get("bucket_cap_mb", 25)
+            )
+        if self.compile_model:
+            forward_model = compile_model(forward_model)
+        mixed_precision = MixedPrecision(self.precision, device)
         self.__reset_hyper_parameter = False
         self.__reset_loss()
         optimizer = self.__hyper_parameter.get_optimizer(
             self.model.parameters())
         lr_scheduler = self.__hyper_parameter.get_lr_scheduler(optimizer)
+
+        start_epoch = 0
+        if self.__resume_state is not None:
+            state = self.__resume_state
+            self.__resume_state = None
+            self.model.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+            lr_scheduler.load_state_dict(state["lr_scheduler"])
+            self.training_loss = state["training_loss"]
+            self.validation_loss = state["validation_loss"]
+            self.validation_accuracy = state["validation_accuracy"]
+            batch_index = state["batch_index"]
+            set_rng_state(state["rng_state"])
+            start_epoch = state["epoch"] + 1
+            get_logger().warning("resume training from epoch %s", start_epoch)
+
+        checkpointer = None
+        if kwargs.get("checkpoint_dir", None) is not None and is_master():
+            checkpointer = Checkpointer(
+                kwargs["checkpoint_dir"], kwargs.get("keep_checkpoint_num", 3)
+            )
+        checkpoint_epoch_interval = int(
+            kwargs.get("checkpoint_epoch_interval", 1))
+
         if "pre_training_callback" in kwargs:
             kwargs["pre_training_callback"](self, optimizer, lr_scheduler)
 
-        for epoch in range(self.__hyper_parameter.epoches):
+        for epoch in range(start_epoch, self.__hyper_parameter.epoches):
             if self.__reset_hyper_parameter:
                 self.__reset_hyper_parameter = False
                 optimizer = self.__hyper_parameter.get_optimizer(
@@ -177,115 +309,227 @@ class Trainer:
                     optimizer)
                 get_logger().warning("use new hyper-parameter")
 
-            training_loss = 0.0
+            if training_sampler is not None:
+                training_sampler.set_epoch(epoch)
+            # callbacks may switch the mode or device of the model between
+            # epochs, so restore them once per epoch rather than per batch
+            self.model.train()
+            self.model.to(device)
+            if self.profiler is not None:
+                self.profiler.begin_epoch()
+            micro_batch_size = self.__hyper_parameter.get_micro_batch_size()
+            training_loss = torch.zeros((), device=device)
             cur_learning_rates = [group["lr"]
                                   for group in optimizer.param_groups]
-            for batch in training_data_loader:
-                self.model.train()
-                self.model.to(device)
+            for batch in profile_iteration(self.profiler, training_data_loader):
                 optimizer.zero_grad()
-                batch_loss = 0
+                batch_loss = torch.zeros((), device=device)
                 real_batch_size = batch[0].shape[0]
 
                 if "pre_batch_callback" in kwargs:
-                    kwargs["pre_batch_callback"](
-                        self.model, batch, batch_index, cur_learning_rates
-                    )
+                    with profile_phase(self.profiler, "pre_batch_callback"):
+                        kwargs["pre_batch_callback"](
+                            self.model, batch, batch_index, cur_learning_rates
+                        )
 
-                instance_inputs = batch[0]
-                instance_inputs = instance_inputs.to(device)
-                instance_targets = batch[1]
-                instance_targets = instance_targets.to(device)
+                with profile_phase(self.profiler, "to_device"):
+                    instance_inputs = batch[0]
+                    instance_inputs = instance_inputs.to(device)
+                    instance_targets = batch[1]
+                    instance_targets = instance_targets.to(device)
                 instance_indices = None
                 if len(batch) >= 3:
-                    instance_indices = [idx.data.item() for idx in batch[2]]
-
-                if "per_instance_gradient_callback" in kwargs:
-                    prev_accumulated_gradient = None
-                    for i, instance_index in enumerate(instance_indices):
-                        instance_index = instance_indices[i]
-                        instance_input = instance_inputs[i]
-                        instance_target = instance_targets[i]
-                        output = self.model(torch.stack([instance_input]))
-                        loss = self.loss_fun(
-                            output, torch.stack(
-                                [instance_target]))
-                        batch_loss += loss.data.item() / real_batch_size
-                        loss.backward()
-                        cur_accumulated_gradient = model_gradients_to_vector(
-                            self.model)
-                        instance_gradient = None
-                        if prev_accumulated_gradient is None:
-                            instance_gradient = cur_accumulated_gradient
-                        else:
-                            instance_gradient = (
-                                cur_accumulated_gradient - prev_accumulated_gradient)
-                        prev_accumulated_gradient = cur_accumulated_gradient
-
-                        if "per_instance_gradient_callback" in kwargs:
-                            kwargs["per_instance_gradient_callback"](
-                                self.model,
-                                instance_index,
-                                instance_gradient,
-                                cur_learning_rates,
-                                real_batch_size,
-                            )
-                else:
-                    outputs = self.model(instance_inputs)
-                    loss = self.loss_fun(outputs, instance_targets)
-                    batch_loss = loss.data.item()
-                    loss.backward()
-
-                if hasattr(self.loss_fun, "reduction") and (
-                    self.loss_fun.reduction == "mean"
-                    or self.loss_fun.reduction == "elementwise_mean"
+                    instance_indices = batch[2].tolist()
+
+                if (
+                    "per_instance_gradient_callback" in kwargs
+                    or "per_instance_gradient_block_callback" in kwargs
                 ):
-                    batch_loss *= real_batch_size
-                    batch_loss /= training_set_size
+                    # the float16 backward runs on scaled losses so that the
+                    # scaler's underflow protection applies
+                    loss_scale = mixed_precision.get_scale()
+                    instance_gradient_blocks = get_per_instance_gradients(
+                        self.model,
+                        self.loss_fun,
+                        instance_inputs,
+                        instance_targets,
+                        chunk_size=kwargs.get(
+                            "per_instance_gradient_chunk_size", micro_batch_size
+                        ),
+                        loss_scale=loss_scale,
+                    )
+                    while True:
+                        with profile_phase(
+                            self.profiler, "per_instance_gradient"
+                        ), mixed_precision.autocast():
+                            block = next(instance_gradient_blocks, None)
+                        if block is None:
+                            break
+                        begin, end, instance_losses, instance_gradients = block
+                        batch_loss += instance_losses.sum() / real_batch_size
+                        accumulate_model_gradients(
+                            self.model, instance_gradients.sum(dim=0)
+                        )
+                        if loss_scale != 1:
+                            instance_gradients = instance_gradients / loss_scale
+
+                        with profile_phase(
+                            self.profiler, "per_instance_gradient_callback"
+                        ):
+                            if "per_instance_gradient_block_callback" in kwargs:
+                                kwargs["per_instance_gradient_block_callback"](
+                                    self.model,
+                                    instance_indices[begin:end],
+                                    instance_gradients,
+                                    cur_learning_rates,
+                                    real_batch_size,
+                                )
+                            if "per_instance_gradient_callback" in kwargs:
+                                for i, instance_index in enumerate(
+                                    instance_indices[begin:end]
+                                ):
+                                    kwargs["per_instance_gradient_callback"](
+                                        self.model,
+                                        instance_index,
+                                        instance_gradients[i],
+                                        cur_learning_rates,
+                                        real_batch_size,
+                                    )
+                    # DistributedDataParallel hooks don't see these gradients
+                    if distributed:
+                        with profile_phase(self.profiler, "all_reduce"):
+                            all_reduce_gradients(self.model)
+                else:
+                    micro_batches = list(
+                        zip(
+                            torch.split(instance_inputs, micro_batch_size),
+                            torch.split(instance_targets, micro_batch_size),
+                        )
+                    )
+                    for i, (micro_inputs, micro_targets) in enumerate(
+                        micro_batches
+                    ):
+                        # only all-reduce gradients after the last micro-batch
+                        sync_context = contextlib.nullcontext()
+                        if distributed and i + 1 < len(micro_batches):
+                            sync_context = forward_model.no_sync()
+                        with sync_context:
+                            with profile_phase(
+                                self.profiler, "forward"
+                            ), mixed_precision.autocast():
+                                outputs = forward_model(micro_inputs)
+                                loss = self.loss_fun(outputs, micro_targets)
+                            if mean_reduction:
+                                loss = loss * micro_inputs.shape[0] / real_batch_size
+                            batch_loss += loss.detach()
+                            with profile_phase(self.profiler, "backward"):
+                                mixed_precision.backward(loss)
+
+                if mean_reduction:
+                    batch_loss *= real_batch_size / training_set_size
 
                 training_loss += batch_loss
                 batch_grad = None
                 if kwargs.get("batch_callback_need_grad", False):
+                    mixed_precision.unscale(optimizer)
                     batch_grad = model_gradients_to_vector(self.model)
 
-                optimizer.step()
+                with profile_phase(self.profiler, "optimizer_step"):
+                    mixed_precision.step(optimizer)
                 cur_learning_rates = [group["lr"]
                                       for group in optimizer.param_groups]
 
                 if "after_batch_callback" in kwargs:
-                    kwargs["after_batch_callback"](
-                        self,
-                        epoch,
-                        batch_index,
-                        real_batch_size,
-                        batch_loss,
-                        cur_learning_rates,
-                        batch_grad=batch_grad,
-                        instance_indices=instance_indices,
-                        optimizer=optimizer,
-                    )
+                    with profile_phase(self.profiler, "after_batch_callback"):
+                        kwargs["after_batch_callback"](
+                            self,
+                            epoch,
+                            batch_index,
+                            real_batch_size,
+                            batch_loss,
+                            cur_learning_rates,
+                            batch_grad=batch_grad,
+                            instance_indices=instance_indices,
+                            optimizer=optimizer,
+                        )
 
                 batch_index += 1
 
-            self.training_loss.append(training_loss)
+            self.training_loss.append(all_reduce_sum(training_loss).item())
 
             if "after_epoch_callback" in kwargs:
-                kwargs["after_epoch_callback"](self, epoch, cur_learning_rates)
-
-            if self.stop_criterion is not None and self.stop_criterion(
-                self, epoch, cur_learning_rates
-            ):
-                get_logger().warning("early stop")
-                break
+                with profile_phase(self.profiler, "after_epoch_callback"):
+                    kwargs["after_epoch_callback"](
+                        self, epoch, cur_learning_rates)
+
+            if self.profiler is not None:
+                self.profiler.end_epoch(epoch, training_set_size)
+
+            if self.stop_criterion is not None:
+                stop = None
+                if is_master():
+                    self.wait_validation()
+                    stop = self.stop_criterion(self, epoch, cur_learning_rates)
+                if broadcast_from_master(stop):
+                    get_logger().warning("early stop")
+                    break
 
             if isinstance(
                     lr_scheduler,
                     torch.optim.lr_scheduler.ReduceLROnPlateau):
-                lr_scheduler.step(
-                    self.training_loss[-1] + self.validation_loss[epoch])
+                # With asynchronous validation the plateau decision uses the
+                # previous epoch so that validation can overlap a whole epoch.
+                plateau_epoch = epoch
+                if kwargs.get("async_validation", False):
+                    plateau_epoch = epoch - 1
+                if plateau_epoch >= 0:
+                    metric = None
+                    if is_master():
+                        self.wait_validation(plateau_epoch)
+                        metric = (
+                            self.training_loss[plateau_epoch]
+                            + self.validation_loss[plateau_epoch]
+                        )
+                    lr_scheduler.step(broadcast_from_master(metric))
             else:
                 lr_scheduler.step()
 
+            if checkpointer is not None and (
+                (epoch + 1) % checkpoint_epoch_interval == 0
+                or epoch + 1 == self.__hyper_parameter.epoches
+            ):
+                checkpointer.save(
+                    epoch,
+                    {
+                        "model": self.model.state_dict(),
+                        "optimizer": optimizer.state_dict(),
+                        "lr_scheduler": lr_scheduler.state_dict(),
+                        "training_loss": self.training_loss,
+                        "batch_index": batch_index,
+                        "rng_state": get_rng_state(),
+                    },
+                    self.__get_validation_state_fun(epoch),
+                )
+        self.wait_validation()
+        if self.__validation_executor is not None:
+            self.__validation_executor.shutdown()
+            self.__validation_executor = None
+        if checkpointer is not None:
+            checkpointer.stop()
+
+    def resume(self, checkpoint_dir, **kwargs):
+        self.__resume_state = Checkpointer(checkpoint_dir).load_latest()
+        if self.__resume_state is None:
+            get_logger().warning("no checkpoint in %s", checkpoint_dir)
+        return self.train(checkpoint_dir=checkpoint_dir, **kwargs)
+
+    def wait_validation(self, epoch=None):
+        epochs = sorted(self.__pending_validations.keys())
+        if epoch is not None:
+            epochs = [e for e in epochs if e <= epoch]
+        for e in epochs:
+            self.__pending_validations.pop(e).result()
+
     def save(self, save_dir):
         if not os.path.isdir(save_dir):
             os.makedirs(save_dir)
@@ -297,6 +541,40 @@ class Trainer:
         model.to(get_cpu_device())
         return model.parameters()
 
+    def __get_validation_state_fun(self, epoch):
+        # runs on the checkpoint thread, so that pending validations are
+        # joined there instead of stalling training
+        futures = [
+            future
+            for e, future in self.__pending_validations.items()
+            if e <= epoch
+        ]
+
+        def get_validation_state():
+            for future in futures:
+                future.result()
+            # dict copies are atomic, later validations may still insert
+            validation_loss = dict(self.validation_loss)
+            validation_accuracy = dict(self.validation_accuracy)
+            return {
+                "validation_loss": {
+                    e: v for e, v in validation_loss.items() if e <= epoch
+                },
+                "validation_accuracy": {
+                    e: v for e, v in validation_accuracy.items() if e <= epoch
+                },
+            }
+
+        return get_validation_state
+
+    def __submit_validation(self, epoch, fn, *args):
+        if self.__validation_executor is None:
+            self.__validation_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1
+            )
+        self.__pending_validations[epoch] = self.__validation_executor.submit(
+            fn, *args)
+
     def __reset_loss(self):
         self.min_training_loss = None
         self.min_training_loss_model = None
@@ -1,3 +1,5 @@
+import hashlib
+
 import torch.nn as nn
 import torch
 import torch.nn.utils.prune as prune
@@ -26,6 +28,35 @@ def model_gradients_to_vector(model):
     )
 
 
+def get_model_version(model):
+    # in-place updates such as optimizer steps and copy_ bump _version
+    return tuple(
+        (tensor.data_ptr(), tensor._version)
+        for tensor in list(model.parameters()) + list(model.buffers())
+    )
+
+
+def get_model_fingerprint(model):
+    fingerprint = hashlib.sha1()
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        fingerprint.update(
+            tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()
+        )
+    return fingerprint.hexdigest()
+
+
+def accumulate_model_gradients(model, vector):
+    offset = 0
+    for parameter in model.parameters():
+        numel = parameter.numel()
+        gradient = vector[offset: offset + numel].view_as(parameter)
+        if parameter.grad is None:
+            parameter.grad = gradient.clone()
+        else:
+            parameter.grad.add_(gradient)
+        offset += numel
+
+
 def get_pruned_parameters(model):
     parameters = dict()
     for layer in model.modules():
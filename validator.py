@@ -1,109 +1,330 @@
+import contextlib
 import copy
+import os
+
 import torch
 
+try:
+    from torch.utils._python_dispatch import TorchDispatchMode
+except ImportError:
+    TorchDispatchMode = None
+
+from .compiler import compile_model
 from .device import get_device
-from .util import model_gradients_to_vector
+from .util import (
+    get_model_fingerprint,
+    get_model_version,
+    model_gradients_to_vector,
+)
 from .hessian_vector_product import hessian_vector_product as _hessian_vector_product
-from .dataset import get_class_count, DatasetWithIndices
+from .hessian_vector_product import hessian_vector_products as _hessian_vector_products
+from .dataset import DatasetWithIndices
+from .metrics import ClassificationMetrics, get_instance_losses
+from .mixed_precision import MixedPrecision
+from .profiler import profile_iteration, profile_phase
+
+
+if TorchDispatchMode is not None:
+
+    class _OutputBytesCounter(TorchDispatchMode):
+        # counts the bytes of every op output that isn't a view, including
+        # functional ops like torch.cat that module hooks don't see
+        def __init__(self):
+            super().__init__()
+            self.output_bytes = 0
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            result = func(*args, **(kwargs or {}))
+            outputs = result if isinstance(result, (list, tuple)) else [result]
+            for output in outputs:
+                if isinstance(output, torch.Tensor) and not output._is_view():
+                    self.output_bytes += output.numel() * output.element_size()
+            return result
 
 
 class Validator:
     def __init__(
-        self, model, loss_fun, dataset,
+        self, model, loss_fun, dataset, share_model=False,
     ):
-        try:
-            self.model = copy.deepcopy(model)
-        except RuntimeError:
-            self.model = model
+        # with share_model the validator borrows model instead of copying it,
+        # and restores its training mode after each pass
+        self.model = model
+        if not share_model:
+            try:
+                self.model = copy.deepcopy(model)
+            except RuntimeError:
+                pass
         self.loss_fun = loss_fun
         self.dataset = dataset
+        self.precision = None
+        self.profiler = None
+        self.compile_model = False
+        self.__compiled_model = None
+        self.num_workers = 0
+        self.memory_budget = None
+        self.__auto_batch_size = None
+        # cache_dir should be specific to the dataset and the loss function
+        self.cache_dir = None
+        self.__gradient_cache = None
 
-    def validate(self, batch_size, **kwargs):
+    def update_model(self, model):
+        if model is self.model:
+            return
+        state_dict = self.model.state_dict()
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                state_dict[name].copy_(tensor)
 
-        class_count = dict()
-        class_correct_count = dict()
-
-        per_class_accuracy = kwargs.get("per_class_accuracy", False)
-        if per_class_accuracy:
-            class_count = get_class_count(self.dataset)
-            for k in class_count.keys():
-                class_correct_count[k] = 0
+    def validate(self, batch_size=None, **kwargs):
+        training = self.model.training
+        try:
+            return self.__validate(batch_size, **kwargs)
+        finally:
+            self.model.train(training)
 
+    def __validate(self, batch_size=None, **kwargs):
+        use_grad = kwargs.get("use_grad", False)
+        if batch_size is None:
+            batch_size = self.get_auto_batch_size()
+        device = get_device()
         per_instance_loss = kwargs.get("per_instance_loss", False)
         dataset = self.dataset
         if per_instance_loss:
             dataset = DatasetWithIndices(dataset)
+        # a private generator keeps the loader from drawing its seed from the
+        # global RNG, which a concurrent training thread is using
         validation_data_loader = torch.utils.data.DataLoader(
-            dataset, batch_size=batch_size
+            dataset,
+            batch_size=batch_size,
+            num_workers=self.num_workers,
+            pin_memory=(device.type == "cuda"),
+            generator=torch.Generator(),
+        )
+        metrics = ClassificationMetrics(
+            per_class_accuracy=kwargs.get("per_class_accuracy", False),
+            instance_num=(len(dataset) if per_instance_loss else None),
+            top_k=kwargs.get("top_k", None),
+            confusion_matrix=kwargs.get("confusion_matrix", False),
         )
 
-        use_grad = kwargs.get("use_grad", False)
-        instance_validation_loss = dict()
-        with torch.set_grad_enabled(use_grad):
-            num_correct = 0
-            num_examples = 0
-            device = get_device()
+        grad_context = torch.enable_grad()
+        if not use_grad:
+            grad_context = Validator.__inference_mode()
+        with grad_context:
+            mixed_precision = MixedPrecision(self.precision, device)
             self.model.eval()
             self.model.zero_grad()
             self.model.to(device)
             validation_loss = torch.zeros(1)
             validation_loss = validation_loss.to(device)
-            for batch in validation_data_loader:
+            for batch in profile_iteration(
+                self.profiler, validation_data_loader, "validation_data_loading"
+            ):
                 real_batch_size = batch[0].shape[0]
-                inputs = batch[0]
-                targets = batch[1]
-                inputs = inputs.to(device)
-                targets = targets.to(device)
-
-                outputs = self.model(inputs)
+                with profile_phase(self.profiler, "validation_to_device"):
+                    inputs = batch[0]
+                    targets = batch[1]
+                    inputs = inputs.to(device, non_blocking=True)
+                    targets = targets.to(device, non_blocking=True)
 
-                if per_instance_loss:
-                    for i, instance_index in enumerate(batch[2]):
-                        instance_index = instance_index.data.item()
-                        instance_validation_loss[instance_index] = self.loss_fun(
-                            outputs[i], targets[i])
-
-                loss = self.loss_fun(outputs, targets)
-                if use_grad:
-                    loss.backward()
-                batch_loss = loss.data.item()
+                with profile_phase(
+                    self.profiler, "validation_forward"
+                ), mixed_precision.autocast():
+                    outputs = self.__get_forward_model()(inputs)
+                    loss = self.loss_fun(outputs, targets)
+                    instance_indices = None
+                    instance_losses = None
+                    if per_instance_loss:
+                        instance_indices = batch[2]
+                        instance_losses = get_instance_losses(
+                            self.loss_fun, outputs.detach(), targets
+                        )
+                batch_loss = loss
                 if hasattr(self.loss_fun, "reduction") and (
                     self.loss_fun.reduction == "mean"
                     or self.loss_fun.reduction == "elementwise_mean"
                 ):
-                    batch_loss *= real_batch_size
-                    batch_loss /= len(dataset)
-                validation_loss += batch_loss
-                correct = torch.eq(torch.max(outputs, dim=1)
-                                   [1], targets).view(-1)
-
-                if per_class_accuracy:
-                    for k in class_count.keys():
-                        class_correct_count[k] += torch.sum(
-                            correct[targets == k]
-                        ).item()
-
-                num_correct += torch.sum(correct).item()
-                num_examples += correct.shape[0]
+                    batch_loss = batch_loss * (real_batch_size / len(dataset))
                 after_batch_callback = kwargs.get("after_batch_callback", None)
+                if use_grad:
+                    # backward runs on the unscaled batch loss, so gradients
+                    # accumulate the batch means, unless mean_gradient asks
+                    # for the gradient of the dataset mean; the callback gets
+                    # the dataset-scaled batch loss
+                    with profile_phase(self.profiler, "validation_backward"):
+                        (
+                            batch_loss
+                            if kwargs.get("mean_gradient", False)
+                            else loss
+                        ).backward(retain_graph=after_batch_callback is not None)
+                validation_loss += batch_loss.detach()
+                with profile_phase(self.profiler, "validation_metrics"):
+                    metrics.update(
+                        outputs, targets, instance_indices, instance_losses
+                    )
                 if after_batch_callback is not None:
-                    after_batch_callback(self.model, batch_loss)
+                    with profile_phase(
+                        self.profiler, "validation_after_batch_callback"
+                    ):
+                        after_batch_callback(self.model, batch_loss)
 
-            if per_class_accuracy:
-                for k in class_count.keys():
-                    class_count[k] = class_correct_count[k] / class_count[k]
             return (
                 validation_loss,
-                num_correct / num_examples,
-                {
-                    "per_class_accuracy": class_count,
-                    "per_instance_loss": instance_validation_loss,
-                },
+                metrics.get_accuracy(),
+                metrics.get_results(),
             )
 
+    def get_auto_batch_size(self):
+        """
+        The largest batch size whose estimated activation memory fits in
+        memory_budget bytes, which defaults to half of the free CUDA memory
+        or 1 GiB on CPU. On CUDA the peak memory of a probe forward pass is
+        measured; on CPU the outputs of all its ops are summed, an upper
+        bound of the peak.
+        """
+        if self.__auto_batch_size is not None:
+            return self.__auto_batch_size
+        device = get_device()
+        memory_budget = self.memory_budget
+        if memory_budget is None:
+            if device.type == "cuda":
+                memory_budget = torch.cuda.mem_get_info(device)[0] // 2
+            else:
+                memory_budget = 2 ** 30
+
+        # index the dataset directly, a DataLoader iterator would draw its
+        # seed from the global RNG and shift a resumed training run
+        probe_batch_size = min(2, len(self.dataset))
+        inputs = torch.utils.data.dataloader.default_collate(
+            [self.dataset[i] for i in range(probe_batch_size)]
+        )[0].to(device)
+        activation_bytes = inputs.numel() * inputs.element_size()
+
+        def hook(module, module_input, module_output):
+            nonlocal activation_bytes
+            if isinstance(module_output, torch.Tensor):
+                activation_bytes += (
+                    module_output.numel() * module_output.element_size()
+                )
+
+        # leaf module outputs are the fallback without dispatch modes
+        handles = []
+        counter = contextlib.nullcontext()
+        if device.type != "cuda":
+            if TorchDispatchMode is not None:
+                counter = _OutputBytesCounter()
+            else:
+                handles = [
+                    module.register_forward_hook(hook)
+                    for module in self.model.modules()
+                    if not list(module.children())
+                ]
+        training = self.model.training
+        try:
+            self.model.eval()
+            self.model.to(device)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+                base_memory = torch.cuda.memory_allocated(device)
+            with Validator.__inference_mode(), counter:
+                self.model(inputs)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+                activation_bytes += (
+                    torch.cuda.max_memory_allocated(device) - base_memory
+                )
+            elif TorchDispatchMode is not None:
+                activation_bytes += counter.output_bytes
+        finally:
+            for handle in handles:
+                handle.remove()
+            self.model.train(training)
+        bytes_per_instance = max(1, activation_bytes // probe_batch_size)
+        self.__auto_batch_size = int(
+            max(1, min(len(self.dataset), memory_budget // bytes_per_instance))
+        )
+        return self.__auto_batch_size
+
+    @staticmethod
+    def __inference_mode():
+        if hasattr(torch, "inference_mode"):
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def __get_forward_model(self):
+        if not self.compile_model:
+            return self.model
+        if self.__compiled_model is None:
+            self.__compiled_model = compile_model(self.model)
+        return self.__compiled_model
+
     def get_gradient(self):
-        self.validate(64, use_grad=True)
-        return model_gradients_to_vector(self.model)
+        """
+        Return the gradient of get_loss_and_gradient, the sum of the
+        gradients of the batch losses over batches of 64. For a mean loss
+        this is not the gradient of the dataset mean, which callers that
+        pair it with the dataset Hessian must compute themselves.
+        """
+        return self.get_loss_and_gradient()[1]
+
+    def get_loss_and_gradient(self):
+        """
+        Return the loss over the dataset, scaled to a dataset mean for a
+        mean loss like validate reports it, and the gradient of
+        validate(64, use_grad=True), the sum of the gradients of the
+        unscaled batch losses. Both are cached per model version.
+        """
+        version = get_model_version(self.model)
+        if self.__gradient_cache is not None and self.__gradient_cache[0] == version:
+            return self.__gradient_cache[1:]
+
+        cache_path = None
+        loss_and_gradient = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(
+                self.cache_dir,
+                "{}_{}.gradient".format(
+                    get_model_fingerprint(self.model),
+                    str(next(self.model.parameters()).dtype).replace("torch.", ""),
+                ),
+            )
+            loss_and_gradient = Validator.__load_cache(cache_path, self.model)
+
+        if loss_and_gradient is None:
+            loss = self.validate(64, use_grad=True)[0].reshape(())
+            gradient = model_gradients_to_vector(self.model)
+            loss_and_gradient = (loss, gradient)
+            if cache_path is not None:
+                Validator.__save_cache(cache_path, loss, gradient)
+        self.__gradient_cache = (version, *loss_and_gradient)
+        return loss_and_gradient
+
+    @staticmethod
+    def __load_cache(cache_path, model):
+        if not os.path.isfile(cache_path):
+            return None
+        parameter = next(model.parameters())
+        # the file holds the loss followed by the flattened gradient
+        data = torch.from_file(
+            cache_path,
+            shared=False,
+            size=sum(p.numel() for p in model.parameters()) + 1,
+            dtype=parameter.dtype,
+        ).to(parameter.device)
+        return data[0], data[1:]
+
+    @staticmethod
+    def __save_cache(cache_path, loss, gradient):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        data = torch.from_file(
+            tmp_path, shared=True, size=gradient.numel() + 1, dtype=gradient.dtype
+        )
+        data[0] = loss.detach()
+        data[1:] = gradient.detach()
+        del data
+        os.replace(tmp_path, cache_path)
 
     def hessian_vector_product(self, v, damping=0):
         res = None
@@ -122,3 +343,24 @@ class Validator:
         if damping != 0:
             res += damping * v
         return res
+
+    def hessian_vector_products(self, vectors, damping=0, chunk_size=None):
+        res = None
+
+        def after_batch_callback(model, batch_loss):
+            nonlocal res
+            products = _hessian_vector_products(
+                model, batch_loss, vectors, chunk_size=chunk_size
+            )
+            if res is None:
+                res = products
+            else:
+                res += products
+
+        self.validate(
+            64,
+            use_grad=True,
+            after_batch_callback=after_batch_callback)
+        if damping != 0:
+            res += damping * vectors.to(res.device)
+        return res